@@ -0,0 +1,446 @@
+#!/usr/bin/python
+import sys
+import time
+import os
+import random
+import subprocess
+import StringIO
+import json
+import argparse
+import platform
+import shutil
+import tempfile
+import riak_graphviz
+from riak_graphviz import Node, DiGraph, parseProfilerOutput
+
+#-----------------------------------------------------------------------
+# Build a graph of nModule modules, each with a call stack of
+# nFn functions, and nEdge cross-module edges
+#-----------------------------------------------------------------------
+
+def makeGraph(nModule, nFn, nEdge):
+
+    digraph = DiGraph({'format':'png'})
+
+    for m in range(nModule):
+        node = Node({'label': 'module' + str(m)})
+        fns = []
+        for f in range(nFn):
+            fns.append({'label': 'module' + str(m) + ':fn' + str(f)})
+        node.append(tuple(fns))
+        digraph.append(node)
+
+    for e in range(nEdge):
+        m1 = e % nModule
+        m2 = (e + 1) % nModule
+        f  = e % nFn
+        digraph.edge('module' + str(m1) + ':fn' + str(f), 'module' + str(m2) + ':fn' + str(f))
+
+    return digraph
+
+#-----------------------------------------------------------------------
+# Time everything render() does short of running graphviz
+#-----------------------------------------------------------------------
+
+def benchRender(nModule, nFn, nEdge):
+    digraph = makeGraph(nModule, nFn, nEdge)
+    start = time.time()
+    digraph.build()
+    return time.time() - start
+
+#-----------------------------------------------------------------------
+# A single module with nFn functions at the same depth, and a single
+# module with a call stack nFn deep
+#-----------------------------------------------------------------------
+
+def makeWideGraph(nFn):
+    digraph = DiGraph({'format':'png'})
+    node = Node({'label': 'module'})
+    node.setNodeAttr('module', 'rank', 'same')
+    node.append([{'label': 'module:fn' + str(f)} for f in range(nFn)])
+    digraph.append(node)
+    return digraph
+
+def makeDeepGraph(nFn):
+    digraph = DiGraph({'format':'png'})
+    node = Node({'label': 'module'})
+    node.append(tuple([{'label': 'module:fn' + str(f)} for f in range(nFn)]))
+    digraph.append(node)
+    return digraph
+
+#-----------------------------------------------------------------------
+# nModule modules with call stacks of increasing depth, padded so
+# that all of them reach the depth of the deepest
+#-----------------------------------------------------------------------
+
+def makeRaggedGraph(nModule, nFn):
+    digraph = DiGraph({'format':'png'})
+    digraph.padToDepth = True
+    for m in range(nModule):
+        node = Node({'label': 'module' + str(m)})
+        node.append(tuple([{'label': 'module' + str(m) + ':fn' + str(f)} for f in range((m + 1) * nFn / nModule)]))
+        digraph.append(node)
+    return digraph
+
+def benchBuild(digraph, singlePass):
+    start = time.time()
+    if singlePass:
+        digraph.build()
+    else:
+        digraph.buildMultiPass()
+    return time.time() - start
+
+#-----------------------------------------------------------------------
+# Memory per node of a graph of nNode functions.  Uses tracemalloc
+# where available, else sums the sizes of each node's own objects
+#-----------------------------------------------------------------------
+
+def nodeBytes(node):
+    size = sys.getsizeof(node) + sys.getsizeof(node.attr)
+    if hasattr(node, '__dict__'):
+        size += sys.getsizeof(node.__dict__)
+    if isinstance(node.node_attr, dict):
+        size += sys.getsizeof(node.node_attr)
+    elif node.extra is not None:
+        size += sys.getsizeof(node.extra)
+    if isinstance(node.nodes, list):
+        size += sys.getsizeof(node.nodes)
+    return size
+
+def benchMemory(nNode):
+    try:
+        import tracemalloc
+        tracemalloc.start()
+        start = tracemalloc.get_traced_memory()[0]
+        digraph = makeGraph(10, nNode / 10, 0)
+        size = tracemalloc.get_traced_memory()[0] - start
+        tracemalloc.stop()
+    except ImportError:
+        digraph = makeGraph(10, nNode / 10, 0)
+        size = 0
+        for node in digraph.walk(False):
+            size += nodeBytes(node)
+    return float(size) / nNode
+
+#-----------------------------------------------------------------------
+# Time a fresh interpreter importing riak_graphviz (best of nRepeat),
+# and report whether the import pulled in numpy or pylab
+#-----------------------------------------------------------------------
+
+def benchImport(nRepeat):
+    best = None
+    for i in range(nRepeat):
+        start = time.time()
+        out = subprocess.check_output([sys.executable, '-c', 'import sys, riak_graphviz; print "numpy" in sys.modules, "pylab" in sys.modules'])
+        elapsed = time.time() - start
+        if best == None or elapsed < best:
+            best = elapsed
+    return (best, out.split())
+
+#-----------------------------------------------------------------------
+# Time DOT generation through the graphviz package (build()) against
+# the direct writer (writeDot())
+#-----------------------------------------------------------------------
+
+def benchDot(nModule, nFn, nEdge):
+    digraph = makeGraph(nModule, nFn, nEdge)
+    start = time.time()
+    digraph.build()
+    source = digraph.dg.source
+    tGraphviz = time.time() - start
+
+    digraph = makeGraph(nModule, nFn, nEdge)
+    start = time.time()
+    digraph.writeDot(StringIO.StringIO())
+    tWriter = time.time() - start
+
+    return (tGraphviz, tWriter)
+
+def benchFindNode(nModule, nFn, nLookup):
+    digraph = makeGraph(nModule, nFn, 0)
+    start = time.time()
+    for i in range(nLookup):
+        digraph.findNode('module' + str(i % nModule) + ':fn' + str(nFn-1))
+    return time.time() - start
+
+#-----------------------------------------------------------------------
+# Write a synthetic profiler output file with nLabel labels
+#-----------------------------------------------------------------------
+
+def writeProfilerFile(fileName, nLabel):
+    with open(fileName, 'w') as f:
+        f.write('totalcount ' + str(nLabel * 10) + '\n')
+        f.write('label ' + ' '.join(["'module:fn" + str(i) + "'" for i in range(nLabel)]) + '\n')
+        f.write('count 0 ' + ' '.join([str(random.randint(1, 100)) for i in range(nLabel)]) + '\n')
+        f.write('usec 0 ' + ' '.join([str(random.randint(1, 100000)) for i in range(nLabel)]) + '\n')
+
+#-----------------------------------------------------------------------
+# Time parsing a profiler file from text, and from the binary cache
+# once it has been written
+#-----------------------------------------------------------------------
+
+def benchParse(nLabel):
+    fileName = 'bench_profile_' + str(nLabel) + '.txt'
+    writeProfilerFile(fileName, nLabel)
+    start = time.time()
+    parseProfilerOutput(fileName, {})
+    tText = time.time() - start
+
+    riak_graphviz.profilerCacheDir = 'bench_cache'
+    parseProfilerOutput(fileName, {})
+    start = time.time()
+    parseProfilerOutput(fileName, {})
+    tCached = time.time() - start
+    riak_graphviz.profilerCacheDir = None
+
+    for cacheFile in os.listdir('bench_cache'):
+        os.remove(os.path.join('bench_cache', cacheFile))
+    os.rmdir('bench_cache')
+    os.remove(fileName)
+    return (tText, tCached)
+
+#-----------------------------------------------------------------------
+# Call fn(*args) in a scratch directory, with every pie-chart drawn up
+# front, so that label timings measure labelling rather than
+# matplotlib, and don't depend on (or leave behind) figs/
+#-----------------------------------------------------------------------
+
+def withWarmPies(fn, *args):
+    cwd = os.getcwd()
+    tmpDir = tempfile.mkdtemp(prefix='riak_graphviz_bench_')
+    os.chdir(tmpDir)
+    try:
+        riak_graphviz.pieGenAll()
+        return fn(*args)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpDir)
+
+#-----------------------------------------------------------------------
+# Labels per second on a graph of nNode functions, with a profile
+# entry for every node
+#-----------------------------------------------------------------------
+
+def benchLabels(nNode):
+    return withWarmPies(benchLabelsWarm, nNode)
+
+def benchLabelsWarm(nNode):
+    digraph = makeGraph(10, nNode / 10, 0)
+    profile = {}
+    for node in digraph.walk(False):
+        profile[node.attr['label']] = {'usec': 1.0, 'count': 1, 'corrusec': random.uniform(1, 1e7), 'frac': random.uniform(0, 100)}
+    start = time.time()
+    digraph.setLabels(profile, 1, (False, False, 0.0, 0))
+    return (nNode + 10) / (time.time() - start)
+
+#-----------------------------------------------------------------------
+# Time the JSON and folded-stack exports of a profiled graph of nNode
+# functions
+#-----------------------------------------------------------------------
+
+def benchExport(nNode):
+    digraph = makeGraph(10, nNode / 10, 0)
+    digraph.nOp = 1
+    for node in digraph.walk(False):
+        digraph.profilerActualDict[node.attr['label']] = {'usec': 1.0, 'count': 1, 'corrusec': random.uniform(1, 1e7), 'frac': random.uniform(0, 100)}
+
+    start = time.time()
+    digraph.writeJson(StringIO.StringIO())
+    tJson = time.time() - start
+
+    start = time.time()
+    digraph.writeFolded(StringIO.StringIO())
+    tFolded = time.time() - start
+
+    return (tJson, tFolded)
+
+#-----------------------------------------------------------------------
+# The benchmark suite.  For each shape (a wide function list, a deep
+# call stack, and ten modules with cross-module edges) and each size,
+# separately time appending the nodes, findNode(), ingesting a
+# synthetic profile covering every node, labelling (setLabels()), DOT
+# generation, and (up to renderMax nodes) an end-to-end render.
+# Returns a list of result dicts
+#-----------------------------------------------------------------------
+
+suiteShapes = [('wide',    lambda n: makeWideGraph(n - 1)),
+               ('deep',    lambda n: makeDeepGraph(n - 1)),
+               ('modules', lambda n: makeGraph(10, n / 10 - 1, n / 10))]
+
+def graphLabels(digraph):
+    return [node.attr['label'] for node in digraph.walk(False)]
+
+def writeSuiteProfile(fileName, labels):
+    labels = labels + ['total']
+    counts = [random.randint(1, 100) for label in labels[:-1]] + [1]
+    usec   = [random.randint(1, 1000) for label in labels[:-1]] + [len(labels) * 1000]
+    with open(fileName, 'w') as f:
+        f.write('totalcount ' + str(len(labels) * 10) + '\n')
+        f.write('label ' + ' '.join(["'" + label + "'" for label in labels]) + '\n')
+        f.write('count 0 ' + ' '.join([str(c) for c in counts]) + '\n')
+        f.write('usec 0 ' + ' '.join([str(u) for u in usec]) + '\n')
+
+def suiteResult(name, shape, nNode, nEdge, seconds, error=None):
+    return {'benchmark': name, 'shape': shape, 'nodes': nNode, 'edges': nEdge, 'seconds': seconds, 'error': error}
+
+def benchSuite(sizes, renderMax=10000, nLookup=10000):
+    return withWarmPies(benchSuiteSizes, sizes, renderMax, nLookup)
+
+def benchSuiteSizes(sizes, renderMax, nLookup):
+
+    results = []
+    for nNode in sizes:
+        for (shape, makeFn) in suiteShapes:
+
+            start   = time.time()
+            digraph = makeFn(nNode)
+            tAppend = time.time() - start
+            nEdge   = len(digraph.edges)
+            labels  = graphLabels(digraph)
+            results.append(suiteResult('append', shape, nNode, nEdge, tAppend))
+
+            start = time.time()
+            for i in range(nLookup):
+                digraph.findNode(labels[i * 7919 % len(labels)])
+            results.append(suiteResult('findNode', shape, nNode, nEdge, time.time() - start))
+
+            clientFile = 'bench_client_' + str(nNode) + '.txt'
+            serverFile = 'bench_server_' + str(nNode) + '.txt'
+            writeSuiteProfile(clientFile, labels)
+            writeSuiteProfile(serverFile, [])
+
+            start = time.time()
+            digraph.ingestProfilerOutput(clientFile, serverFile, None, None, None, None, 'total')
+            results.append(suiteResult('ingestProfilerOutput', shape, nNode, nEdge, time.time() - start))
+            digraph.nOp = 1
+
+            profile = digraph.profilerActualDict
+            start = time.time()
+            digraph.setLabels(profile, digraph.nOp, (False, False, 0.0, 0))
+            results.append(suiteResult('setLabels', shape, nNode, nEdge, time.time() - start))
+
+            digraph = makeFn(nNode)
+            digraph.profilerActualDict = profile
+            digraph.nOp = 1
+            start = time.time()
+            digraph.writeDot(StringIO.StringIO())
+            results.append(suiteResult('writeDot', shape, nNode, nEdge, time.time() - start))
+
+            if nNode <= renderMax:
+                digraph = makeFn(nNode)
+                digraph.profilerActualDict = profile
+                digraph.nOp = 1
+                digraph.fastDot = True
+                name = 'bench_render_' + shape + '_' + str(nNode)
+                start = time.time()
+                error = None
+                try:
+                    digraph.render(name)
+                except Exception as err:
+                    error = str(err)
+                results.append(suiteResult('render', shape, nNode, nEdge, time.time() - start, error))
+                for fileName in [name, name + '.' + digraph.dg.format]:
+                    if os.path.exists(fileName):
+                        os.remove(fileName)
+
+            os.remove(clientFile)
+            os.remove(serverFile)
+
+    return results
+
+def runSuite(sizes, renderMax, outFileName):
+    report = {'time': time.time(),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'results': benchSuite(sizes, renderMax)}
+    if outFileName == None:
+        print json.dumps(report, indent=2, sort_keys=True)
+    else:
+        with open(outFileName, 'w') as f:
+            f.write(json.dumps(report, indent=2, sort_keys=True) + '\n')
+
+def runTables():
+
+    (tImport, loaded) = benchImport(5)
+    print '%12s %8s %8s' % ('import (s)', 'numpy', 'pylab')
+    print '%12.4f %8s %8s' % (tImport, loaded[0], loaded[1])
+    print ''
+
+    print '%8s %8s %12s %12s' % ('nodes', 'edges', 'build (s)', 'find (s)')
+
+    for nFn in [10, 100, 1000]:
+        nModule = 10
+        nEdge = nModule * nFn / 10
+        tRender = benchRender(nModule, nFn, nEdge)
+        tFind   = benchFindNode(nModule, nFn, 1000)
+        print '%8d %8d %12.4f %12.4f' % (nModule * (nFn + 1), nEdge, tRender, tFind)
+
+    print ''
+    print '%8s %8s %12s %12s' % ('shape', 'nodes', 'single (s)', 'multi (s)')
+
+    for nFn in [100, 500]:
+        for (shape, makeFn) in [('wide', makeWideGraph), ('deep', makeDeepGraph)]:
+            tSingle = benchBuild(makeFn(nFn), True)
+            tMulti  = benchBuild(makeFn(nFn), False)
+            print '%8s %8d %12.4f %12.4f' % (shape, nFn + 1, tSingle, tMulti)
+
+    # Call stacks far deeper than the recursion limit
+
+    print ''
+    print '%8s %12s' % ('depth', 'build (s)')
+
+    for nFn in [10 * sys.getrecursionlimit(), 100000]:
+        print '%8d %12.4f' % (nFn, benchBuild(makeDeepGraph(nFn), True))
+
+    print ''
+    print '%8s %8s %12s' % ('modules', 'depth', 'padded (s)')
+
+    for nFn in [100, 1000]:
+        print '%8d %8d %12.4f' % (10, nFn, benchBuild(makeRaggedGraph(10, nFn), True))
+
+    print ''
+    print '%8s %8s %12s %12s' % ('nodes', 'edges', 'graphviz (s)', 'writer (s)')
+
+    for nFn in [1000, 10000]:
+        (tGraphviz, tWriter) = benchDot(10, nFn, 10 * nFn)
+        print '%8d %8d %12.4f %12.4f' % (10 * (nFn + 1), 10 * nFn, tGraphviz, tWriter)
+
+    print ''
+    print '%8s %12s' % ('nodes', 'bytes/node')
+
+    for nNode in [10000, 100000]:
+        print '%8d %12.1f' % (nNode, benchMemory(nNode))
+
+    print ''
+    print '%8s %12s' % ('nodes', 'labels/s')
+
+    for nNode in [50000]:
+        print '%8d %12.0f' % (nNode, benchLabels(nNode))
+
+    print ''
+    print '%8s %12s %12s' % ('nodes', 'json (s)', 'folded (s)')
+
+    for nNode in [10000, 100000]:
+        (tJson, tFolded) = benchExport(nNode)
+        print '%8d %12.4f %12.4f' % (nNode, tJson, tFolded)
+
+    print ''
+    print '%8s %12s %12s' % ('labels', 'parse (s)', 'cached (s)')
+
+    for nLabel in [10000, 100000, 1000000]:
+        (tText, tCached) = benchParse(nLabel)
+        print '%8d %12.4f %12.4f' % (nLabel, tText, tCached)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark riak_graphviz')
+    parser.add_argument('--suite', action='store_true', help='run the benchmark suite, with machine-readable (JSON) output')
+    parser.add_argument('--sizes', default='1000,10000,100000,1000000', help='comma-separated node counts for the suite')
+    parser.add_argument('--render-max', type=int, default=10000, help='largest graph to render end-to-end in the suite')
+    parser.add_argument('--out', default=None, help='file to write the suite results to (default: stdout)')
+    args = parser.parse_args()
+
+    if args.suite:
+        runSuite([int(size) for size in args.sizes.split(',')], args.render_max, args.out)
+    else:
+        runTables()
@@ -2,102 +2,422 @@
 import sys
 import graphviz as gv
 import functools
-import numpy
-import pylab
+import hashlib
+import heapq
+import itertools
+import json
+import math
 import os
+import re
+import time
+import StringIO
+import multiprocessing
+import subprocess
+import tempfile
+import warnings
+import zipfile
+try:
+    import resource
+except ImportError:
+    resource = None
 
 face="verdana"
 
+#-----------------------------------------------------------------------
+# Templates for the rows of an HTML-like node label
+#-----------------------------------------------------------------------
+
+labelHead = '<<TABLE border="0" cellborder="0">'
+labelTail = '</TABLE>>'
+labelRow  = '<TR><TD><FONT face="%s" color="%s">%s</FONT></TD></TR>'
+pieRow    = '<TR><TD width="30" height="30" fixedsize="true"><IMG SRC="%s" scale="true"/></TD></TR>'
+
+#-----------------------------------------------------------------------
+# numpy and pylab are only needed for profiler data and pie-charts,
+# and are slow to import, so they are loaded on first use.  pylab
+# gets the headless Agg backend unless one was chosen via MPLBACKEND
+# or by importing pyplot first
+#-----------------------------------------------------------------------
+
+numpy = None
+pylab = None
+
+def loadNumpy():
+    global numpy
+    if numpy == None:
+        import numpy as np
+        numpy = np
+    return numpy
+
+def loadPylab():
+    global pylab
+    if pylab == None:
+        import matplotlib
+        if 'MPLBACKEND' not in os.environ and 'matplotlib.pyplot' not in sys.modules:
+            matplotlib.use('Agg')
+        import pylab as pl
+        pylab = pl
+    return pylab
+
+#=======================================================================
+# Class for instrumenting the phases of a render: parsing, profile
+# correction, structure, labels, pie-charts, subgraphs, edges, DOT
+# source, and the dot subprocess.  For each phase, the wall time,
+# number of calls and growth in peak RSS (bytes) are accumulated.
+# Peak RSS only ever increases, so peakRssGrowth is charged to the
+# phase that first pushed the process to a new high-water mark; it is
+# not the memory a phase used, and any later phase that stays below
+# the mark reports 0.  Phases nest (labels include pie-charts, and
+# render includes everything after parsing), so their times are
+# inclusive.  Values of interest (total times and counts) are
+# recorded alongside.
+#
+# The module-wide instance is enabled by setting the
+# RIAK_GRAPHVIZ_INSTRUMENT environment variable.  Any value other
+# than 1 is taken as a file name, to which the report is written as
+# JSON after each render
+#=======================================================================
+
+class Instrumentation(object):
+
+    def __init__(self, enabled=False, reportFileName=None):
+        self.enabled        = enabled
+        self.reportFileName = reportFileName
+        self.reset()
+
+    def reset(self):
+        self.phases = {}
+        self.values = {}
+
+    def phase(self, name):
+        if self.enabled:
+            return InstrumentationPhase(self, name)
+        return noPhase
+
+    def record(self, name, value):
+        if self.enabled:
+            self.values[name] = value
+
+    def report(self):
+        return {'phases': dict([(name, dict(stats)) for (name, stats) in self.phases.iteritems()]),
+                'values': dict(self.values)}
+
+    def json(self):
+        return json.dumps(self.report(), indent=2, sort_keys=True)
+
+    def renderDone(self):
+        if self.enabled and self.reportFileName != None:
+            with open(self.reportFileName, 'w') as f:
+                f.write(self.json() + '\n')
+
+#-----------------------------------------------------------------------
+# Peak resident set size of this process, in bytes (ru_maxrss is in
+# kilobytes on Linux, but already in bytes on macOS)
+#-----------------------------------------------------------------------
+
+def peakRss():
+    if resource == None:
+        return 0
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss
+    return maxrss * 1024
+
+class InstrumentationPhase(object):
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.peakRss = peakRss()
+        self.start  = time.time()
+
+    def __exit__(self, excType, excValue, traceback):
+        stats = self.instrumentation.phases.get(self.name)
+        if stats == None:
+            stats = {'time': 0.0, 'calls': 0, 'peakRssGrowth': 0}
+            self.instrumentation.phases[self.name] = stats
+        stats['time']   += time.time() - self.start
+        stats['calls']  += 1
+        stats['peakRssGrowth'] += peakRss() - self.peakRss
+        return False
+
+class NoPhase(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+noPhase = NoPhase()
+
+instrumentEnv = os.environ.get('RIAK_GRAPHVIZ_INSTRUMENT')
+if instrumentEnv in [None, '', '0', '1']:
+    instrumentation = Instrumentation(instrumentEnv == '1')
+else:
+    instrumentation = Instrumentation(True, instrumentEnv)
+
 #=======================================================================
-# A class for managing a node in a digraph
+# A dict-like view of a node's non-graphviz attributes.  The common
+# attributes (depth, frac and rank) live in slots on the node itself;
+# any others go in a per-node dict that is only created when first
+# written.  A slot holding None is treated as absent
 #=======================================================================
 
-class Node:
+class NodeAttr(object):
+
+    __slots__ = ('node',)
+
+    slotKeys = ('depth', 'frac', 'rank')
+
+    def __init__(self, node):
+        self.node = node
+
+    def __getitem__(self, key):
+        if key in NodeAttr.slotKeys:
+            val = getattr(self.node, key)
+            if val is None:
+                raise KeyError(key)
+            return val
+        if self.node.extra is None:
+            raise KeyError(key)
+        return self.node.extra[key]
+
+    def __setitem__(self, key, val):
+        if key in NodeAttr.slotKeys:
+            setattr(self.node, key, val)
+        else:
+            if self.node.extra is None:
+                self.node.extra = {}
+            self.node.extra[key] = val
+
+    def __delitem__(self, key):
+        if key in NodeAttr.slotKeys and getattr(self.node, key) is not None:
+            setattr(self.node, key, None)
+        elif self.node.extra is not None and key in self.node.extra:
+            del self.node.extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in NodeAttr.slotKeys:
+            return getattr(self.node, key) is not None
+        return self.node.extra is not None and key in self.node.extra
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def keys(self):
+        keys = [key for key in NodeAttr.slotKeys if getattr(self.node, key) is not None]
+        if self.node.extra is not None:
+            keys.extend(self.node.extra.keys())
+        return keys
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+#=======================================================================
+# A class for managing a node in a digraph.  Nodes use __slots__, and
+# leaf nodes share the empty noNodes tuple until something is
+# appended to them, to keep large graphs compact
+#=======================================================================
+
+noNodes = ()
+
+class Node(object):
+
+    __slots__ = ('nodes', 'attr', 'depth', 'frac', 'rank', 'extra', 'graph')
 
     def __init__(self, args):
         if isinstance(args, dict):
-            self.nodes = []
+            self.nodes = noNodes
             self.attr  = args
-            self.node_attr = {'depth':0, 'frac':-1, 'rank':'descending'}
+            self.depth = 0
+            self.frac  = -1
+            self.rank  = 'descending'
+            self.extra = None
+            self.graph = None
         elif isinstance(args, Node):
+
+            # A copy shares its source's children and extra node
+            # attributes, so materialise them first
+
+            if args.nodes is noNodes:
+                args.nodes = []
+            if args.extra is None:
+                args.extra = {}
+
             self.nodes = args.nodes
             self.attr  = args.attr
-            self.node_attr = args.node_attr
+            self.depth = args.depth
+            self.frac  = args.frac
+            self.rank  = args.rank
+            self.extra = args.extra
+            self.graph = None
         else:
             raise TypeError("constructor must be called with either a dictionary or a Node object")
+
+    #------------------------------------------------------------
+    # Pickle support: slots have no __dict__, so the state is
+    # collected explicitly (along with the __dict__ of subclasses)
+    #------------------------------------------------------------
+
+    def __getstate__(self):
+        state = dict([(key, getattr(self, key)) for key in Node.__slots__])
+        if hasattr(self, '__dict__'):
+            state.update(self.__dict__)
+        return state
+
+    def __setstate__(self, state):
+        for (key, val) in state.items():
+            setattr(self, key, val)
+
+    def getNodeAttr(self):
+        return NodeAttr(self)
+
+    def setNodeAttrDict(self, attrDict):
+        self.depth = attrDict.get('depth')
+        self.frac  = attrDict.get('frac')
+        self.rank  = attrDict.get('rank')
+        self.extra = None
+        for key in attrDict.keys():
+            if key not in NodeAttr.slotKeys:
+                NodeAttr(self)[key] = attrDict[key]
+
+    node_attr = property(getNodeAttr, setNodeAttrDict)
         
     def setFrac(self, frac):
         self.frac = frac
         
-    def setDepth(self, depth):
+    #------------------------------------------------------------
+    # Generator over this node (unless includeSelf is False) and all
+    # of its descendants, in pre-order.  All tree walks go through
+    # this (or an explicit stack), so that arbitrarily deep call
+    # stacks never hit the recursion limit
+    #------------------------------------------------------------
 
-        if 'defDepth' not in self.node_attr.keys():
-            self.node_attr['depth'] = depth
+    def walk(self, includeSelf=True):
+        if includeSelf:
+            stack = [self]
         else:
-            self.node_attr['depth'] = self.node_attr['defDepth']
-            
-        for i in range(len(self.nodes)):
-            if self.node_attr['rank'] == 'same':
-                self.nodes[i].setDepth(depth + 1)
+            stack = list(self.nodes[::-1])
+        while len(stack) > 0:
+            node = stack.pop()
+            yield node
+            stack.extend(node.nodes[::-1])
+
+    def setDepth(self, depth):
+        stack = [(self, depth)]
+        while len(stack) > 0:
+            (node, depth) = stack.pop()
+
+            if 'defDepth' not in node.node_attr:
+                node.depth = depth
             else:
-                self.nodes[i].setDepth(depth + i + 1)
+                node.depth = node.node_attr['defDepth']
+            
+            for i in range(len(node.nodes)):
+                if node.rank == 'same':
+                    stack.append((node.nodes[i], depth + 1))
+                else:
+                    stack.append((node.nodes[i], depth + i + 1))
 
     def getMaxDepth(self):
-        maxDepth = self.node_attr['depth']
-        for node in self.nodes:
-            newMaxDepth = node.getMaxDepth()
-            if newMaxDepth > maxDepth:
-                maxDepth = newMaxDepth
+        maxDepth = self.depth
+        for node in self.walk(False):
+            if node.depth > maxDepth:
+                maxDepth = node.depth
         return maxDepth
 
+    #------------------------------------------------------------
+    # Return the first node (in pre-order) at the maximum depth
+    #------------------------------------------------------------
+
     def getDeepestNode(self):
-        maxDepth = self.node_attr['depth']
+        maxDepth = self.depth
         maxNode  = self
-        for node in self.nodes:
-            newMaxDepth = node.getMaxDepth()
-            newMaxNode  = node.getDeepestNode()
-            if newMaxDepth > maxDepth:
-                maxDepth = newMaxDepth
-                maxNode  = newMaxNode
+        for node in self.walk(False):
+            if node.depth > maxDepth:
+                maxDepth = node.depth
+                maxNode  = node
         return maxNode
 
-    def appendInvisibleNode(self):
-        print 'Inside AIN'
-        name = getTag(self.attr) + '_sub'
+    #------------------------------------------------------------
+    # Compute, in a single post-order pass, the maximum depth and the
+    # deepest node (as getDeepestNode() would find it) of the subtree
+    # below every node.  Returns a dict of node -> (maxDepth, node)
+    #------------------------------------------------------------
+
+    def getSubtreeDepths(self):
+        table = {}
+        stack = [(self, False)]
+        while len(stack) > 0:
+            (node, visited) = stack.pop()
+            if not visited:
+                stack.append((node, True))
+                for child in node.nodes:
+                    stack.append((child, False))
+            else:
+                maxDepth = node.depth
+                maxNode  = node
+                for child in node.nodes:
+                    (childDepth, childNode) = table[child]
+                    if childDepth > maxDepth:
+                        maxDepth = childDepth
+                        maxNode  = childNode
+                table[node] = (maxDepth, maxNode)
+        return table
+
+    #------------------------------------------------------------
+    # Append an invisible padding node (and edge) below this node
+    #------------------------------------------------------------
+
+    def appendInvisibleNode(self, name=None):
+        if name == None:
+            name = getTag(self.attr, False) + '_sub'
         depth = self.node_attr['depth']
-        print 'Would append ' + name + ' at depth ' + str(depth)
-        node  = self.append({'label': name, 'color':'blue'})
+        node  = self.append({'label': name, 'style':'invis'})
         node.node_attr['depth'] = depth + 1
+        node.node_attr['pad'] = True
         return node
         
     def setShape(self, shape):
-        for node in self.nodes:
+        for node in self.walk(False):
             if 'shape' not in node.node_attr.keys():
                 node.attr['shape'] = shape
             else:
                 node.attr['shape'] = node.node_attr['shape']
-            node.setShape(shape)
 
     def setArrowhead(self, shape):
-        for node in self.nodes:
+        for node in self.walk(False):
             node.attr['arrowhead'] = shape
-            node.setArrowhead(shape)
 
     def getNodesAtDepth(self, depth, nodeList):
-        for node in self.nodes:
-            if node.node_attr['depth'] == depth:
+        for node in self.walk(False):
+            if node.depth == depth:
                 nodeList.append(node)
-            nodeList = node.getNodesAtDepth(depth, nodeList)
         return nodeList
 
     def printNodes(self, depth=0):
-        prefix = ''
-        for i in range(0,depth):
-            prefix = prefix + ' '
-        print prefix + self.attr['label'] + '->'
-
-        for node in self.nodes:
-            node.printNodes(depth+1)
+        stack = [(self, depth)]
+        while len(stack) > 0:
+            (node, depth) = stack.pop()
+            print ' ' * depth + node.attr['label'] + '->'
+            for child in node.nodes[::-1]:
+                stack.append((child, depth+1))
                     
     def calls(self, nodes):
         if isinstance(nodes, list):
@@ -126,12 +446,18 @@ class Node:
     #------------------------------------------------------------
     
     def append(self, node):
+        if self.nodes is noNodes:
+            self.nodes = []
         if isinstance(node, Node):
             self.nodes.append(node)
+            if self.graph != None:
+                self.graph.indexSubtree(node, self, len(self.nodes)-1)
             return self
         elif isinstance(node, dict):
             n = Node(node)
             self.nodes.append(n)
+            if self.graph != None:
+                self.graph.indexSubtree(n, self, len(self.nodes)-1)
             return n
         elif isinstance(node, list):
             for n in node:
@@ -166,7 +492,10 @@ class Node:
         
         if parent1 == parent2:
             inNode = Node(node)
-            return parent1.nodes.insert(index1+1,  inNode)
+            ret = parent1.nodes.insert(index1+1,  inNode)
+            if self.graph != None:
+                self.graph.reindexChildren(parent1)
+            return ret
         
         # Case 2: node1 is parent of node2
         #
@@ -180,37 +509,30 @@ class Node:
             inNode = Node(node)
             inNode.append(node2)
             node1.nodes.remove(node2)
-            return node1.nodes.insert(index2+1, inNode)
+            ret = node1.nodes.insert(index2+1, inNode)
+            if self.graph != None:
+                self.graph.reindexChildren(node1)
+            return ret
 
         else:
             return None
             
     def findNode(self, tag):
-        if getTag(self.attr) == sanitizeForGraphviz(tag):
-            return self
-        else:
-            for n in self.nodes:
-                node = n.findNode(tag)
-                if node != None:
-                    return node
+        tag = sanitizeForGraphviz(tag)
+        for node in self.walk():
+            if getTag(node.attr) == tag:
+                return node
         return None
 
     def findParentOfNode(self, tag):
 
-        # See if we are the parent
+        # Check the children of each node in turn, starting with our own
 
-        index=0
-        for n in self.nodes:
-            if getTag(n.attr) == sanitizeForGraphviz(tag):
-                return [self, index]
-            index = index+1
-
-        # Else see if one of our children is the parent
-        
-        for n in self.nodes:
-            [node, index] = n.findParentOfNode(tag)
-            if node != None:
-                return [node, index]
+        tag = sanitizeForGraphviz(tag)
+        for node in self.walk():
+            for index in range(len(node.nodes)):
+                if getTag(node.nodes[index].attr) == tag:
+                    return [node, index]
 
         # Else return None
         
@@ -220,110 +542,138 @@ class Node:
     # Connect this node to its children, and its children to theirs
     #------------------------------------------------------------
 
-    def connectNodes(self, graph, delta=False):
-
-        # Connect this node to all of its children, and its children to theirs
+    #------------------------------------------------------------
+    # The stack holds three kinds of entries: 'enter' a node, draw the
+    # 'edge' from a node to one of its children, and 'exit' a node
+    # once all of its children have been visited
+    #------------------------------------------------------------
 
-        attr = {}
-        for node in self.nodes:
-            if delta:
-                attr['color'] = 'gray'
-            if 'arrowhead' in self.attr.keys():
-                attr['arrowhead'] = self.attr['arrowhead']
+    def connectNodes(self, graph, delta=False):
 
-            if 'color' in node.attr.keys() and node.attr['color'] == 'gray':
-                attr['color'] = 'gray'
+        stack = [('enter', self)]
+        while len(stack) > 0:
+            item = stack.pop()
+
+            # Connect this node to all of its children, and its children to theirs
+
+            if item[0] == 'enter':
+                node = item[1]
+                attr = {}
+                stack.append(('exit', node))
+                for child in node.nodes[::-1]:
+                    stack.append(('enter', child))
+                    stack.append(('edge', node, child, attr))
+
+            elif item[0] == 'edge':
+                (kind, node, child, attr) = item
+                if delta:
+                    attr['color'] = 'gray'
+                if 'arrowhead' in node.attr.keys():
+                    attr['arrowhead'] = node.attr['arrowhead']
+
+                if 'color' in child.attr.keys() and child.attr['color'] == 'gray':
+                    attr['color'] = 'gray'
                 
-            graph.edge(getTag(self.attr), getTag(node.attr), **attr)
-            node.connectNodes(graph, delta)
+                if 'pad' in child.node_attr:
+                    graph.edge(getTag(node.attr), getTag(child.attr), **dict(attr, style='invis'))
+                else:
+                    graph.edge(getTag(node.attr), getTag(child.attr), **attr)
 
-        # And also connect the child nodes, else graphviz won't enforce ordering
+            # And also connect the child nodes, else graphviz won't enforce ordering
 
-        d = {'color':'invis'}
-        for i in range(1, len(self.nodes)):
-            graph.edge(getTag(self.nodes[i-1].attr), getTag(self.nodes[i].attr), **d)
+            else:
+                node = item[1]
+                d = {'color':'invis'}
+                for i in range(1, len(node.nodes)):
+                    graph.edge(getTag(node.nodes[i-1].attr), getTag(node.nodes[i].attr), **d)
 
     def setAllAttr(self, attr, val):
-        self.attr[attr] = val
-        for node in self.nodes:
-            node.setAllAttr(attr, val)
+        for node in self.walk():
+            node.attr[attr] = val
 
     def setAttr(self, nodeName, attr, val):
-        if sanitizeForGraphviz(nodeName) == getTag(self.attr):
-            self.attr[attr] = val
-        for node in self.nodes:
-            node.setAttr(nodeName, attr, val)
+        tag = sanitizeForGraphviz(nodeName)
+        for node in self.walk():
+            if getTag(node.attr) == tag:
+                node.attr[attr] = val
 
     def setNodeAttr(self, nodeName, attr, val):
-        if sanitizeForGraphviz(nodeName) == getTag(self.attr):
-            self.node_attr[attr] = val
-        for node in self.nodes:
-            node.setNodeAttr(nodeName, attr, val)
+        tag = sanitizeForGraphviz(nodeName)
+        for node in self.walk():
+            if getTag(node.attr) == tag:
+                node.node_attr[attr] = val
 
     def setLabels(self, profilerActualDict, nQuery, deltaTuple):
-        for node in self.nodes:
+        for node in self.walk(False):
             node.renderLabel(profilerActualDict, nQuery, deltaTuple)
-            node.setLabels(profilerActualDict, nQuery, deltaTuple)
 
-    def constructLabel(self, tag, label, profilerActualDict, nQuery, deltaTuple, color=None):
+    #------------------------------------------------------------
+    # Construct the HTML label for a node or edge.  Styling (and
+    # delta-mode coloring) is read from and written to attr, which
+    # defaults to this node's own attributes
+    #------------------------------------------------------------
+
+    def constructLabel(self, tag, label, profilerActualDict, nQuery, deltaTuple, color=None, attr=None):
+
+        if attr == None:
+            attr = self.attr
 
         (delta, deltaFrac, refUsec, threshold) = deltaTuple
-        
-        if not os.path.isdir("figs"):
-            os.mkdir("figs")
-            
-        if tag in profilerActualDict.keys():
-            frac = profilerActualDict[tag]['frac']
+
+        entry = profilerActualDict.get(tag)
+        if entry != None:
+            frac = entry['frac']
 
             if deltaFrac:
                 val = frac
             else:
-                val = profilerActualDict[tag]['corrusec']
-                #print 'REFUSEC = ' + str(refUsec)
+                val = entry['corrusec']
         else:
             frac = -1
             val = 0.0
             threshold = 0.0
             
         pieColor = 'red'
-        if delta and (numpy.abs(val) < threshold or tag not in profilerActualDict.keys()):
-            self.attr['color'] = 'gray'
+        if delta and (abs(val) < threshold or entry == None):
+            attr['color'] = 'gray'
             color = 'gray'
             pieColor = 'white'
         elif delta and val <= 0.0:
-            self.attr['color'] = 'darkgreen'
+            attr['color'] = 'darkgreen'
             pieColor = 'darkgreen'
-            self.attr['penwidth'] = '2'
-            self.attr['style'] = 'filled'
-            self.attr['fillcolor'] = 'darkseagreen1'
+            attr['penwidth'] = '2'
+            attr['style'] = 'filled'
+            attr['fillcolor'] = 'darkseagreen1'
         elif delta and val > 0.0:
-            self.attr['color'] = 'red'
+            attr['color'] = 'red'
             pieColor = 'red'
-            self.attr['penwidth'] = '2'
-            self.attr['style'] = 'filled'
-            self.attr['fillcolor'] = 'mistyrose'
+            attr['penwidth'] = '2'
+            attr['style'] = 'filled'
+            attr['fillcolor'] = 'mistyrose'
         
-        if frac >= 0:
-            pieGen(frac, pieColor)
-        elif delta and tag in profilerActualDict.keys():
-            pieGen(numpy.abs(frac), pieColor)
-            
-        substr = label.split(':')
-        n = len(substr)
-        retLabel = '<<TABLE border="0" cellborder="0">'
+        # A percent change (see ProfileComparison.deltaDict()) can
+        # exceed 100%: the pie is clamped, and the label shows the full
+        # percentage
 
-        if 'labelcolor' in self.attr.keys():
-            color = self.attr['labelcolor']
+        vector = self.graph != None and self.graph.dg.format == 'svg'
+        if frac >= 0 or (delta and entry != None):
+            pieFile = pieGen(min(abs(frac), 100.0), pieColor, vector=vector)
+            
+        if 'labelcolor' in attr:
+            color = attr['labelcolor']
 
         if color == None:
             color = 'black'
 
-        if n == 1:
-            retLabel += '<TR><TD><FONT face="' + face + '" color="' + color + '">' + substr[0] + '</FONT></TD></TR>'
+        substr = label.split(':')
+        rows = [labelHead]
+
+        if len(substr) == 1:
+            rows.append(labelRow % (face, color, substr[0]))
         else:
-            retLabel += '<TR><TD><FONT face="' + face + '" color="gray">' + substr[0] + '</FONT></TD></TR>'
-            for i in range(1,n):
-                retLabel += '<TR><TD><FONT face="' + face + '" color="' + color + '">' + substr[i] + '</FONT></TD></TR>'
+            rows.append(labelRow % (face, 'gray', substr[0]))
+            for sub in substr[1:]:
+                rows.append(labelRow % (face, color, sub))
 
         if not delta and frac >= 0:
 
@@ -332,12 +682,15 @@ class Node:
             else:
                 fracStr = str(int(frac)) + '%'
 
-            retLabel += '<TR><TD width="30" height="30" fixedsize="true">' + '<IMG SRC="figs/pc_' + str(int(frac)) + '.png" scale="true"/>' + '</TD></TR>'
-            retLabel += '<TR><TD><FONT face="' + face + '" color="gray">' + getTimeStr(profilerActualDict[tag]['corrusec']/nQuery) + ' (' + fracStr + ')</FONT></TD></TR>'
+            rows.append(pieRow % pieFile)
+            rows.append(labelRow % (face, 'gray', getTimeStr(entry['corrusec']/nQuery) + ' (' + fracStr + ')'))
 
-        elif delta and tag in profilerActualDict.keys():
+            if 'stats' in entry:
+                rows.append(labelRow % (face, 'gray', getStatsStr(entry['stats'], nQuery)))
 
-            if numpy.abs(frac) < 1.0:
+        elif delta and entry != None:
+
+            if abs(frac) < 1.0:
                 if frac < 0.0:
                     fracStr = '- &lt; 1%'
                 else:
@@ -347,48 +700,72 @@ class Node:
             else:
                 fracStr = '+' + str(int(frac)) + '%'
 
-            timeStr = getTimeStr(profilerActualDict[tag]['corrusec']/nQuery, delta)
-                
-            retLabel += '<TR><TD width="30" height="30" fixedsize="true">' + '<IMG SRC="figs/pc_' + str(numpy.abs(int(frac))) + '.png" scale="true"/>' + '</TD></TR>'
-            retLabel += '<TR><TD><FONT face="' + face + '" color="gray">' + timeStr + ' (' + fracStr + ')</FONT></TD></TR>'
+            rows.append(pieRow % pieFile)
+            rows.append(labelRow % (face, 'gray', getTimeStr(entry['corrusec']/nQuery, delta) + ' (' + fracStr + ')'))
             
-        if 'annotation' in self.attr.keys():
-            annotation = self.attr['annotation']
+        if 'annotation' in attr:
+            annotation = attr['annotation']
             annotation = annotation.strip(' ')
-            substr = annotation.split(':')
 
             # Default to node-wide annotation color if one is set
             
-            if 'annotationcolor' in self.node_attr.keys():
+            if 'annotationcolor' in self.node_attr:
                 annotationcolor = self.node_attr['annotationcolor']
             else:
                 annotationcolor = 'blue'
 
             # But override with individual annotation color
             
-            if 'annotationcolor' in self.attr.keys():
-                annotationcolor = self.attr['annotationcolor']
+            if 'annotationcolor' in attr:
+                annotationcolor = attr['annotationcolor']
 
-            for sub in substr:
-                retLabel += '<TR><TD><FONT face="' + face + '" color="' + annotationcolor + '">' + sub + '</FONT></TD></TR>'
+            for sub in annotation.split(':'):
+                rows.append(labelRow % (face, annotationcolor, sub))
             
-        retLabel += '</TABLE>>'
+        rows.append(labelTail)
 
-        return retLabel
+        return ''.join(rows)
     
-    def renderLabel(self, profilerActualDict, nQuery, deltaTuple):
+    #------------------------------------------------------------
+    # Replace the label in attr (by default, this node's attributes)
+    # with its rendered HTML, keeping the original label as the tag
+    #------------------------------------------------------------
+
+    def renderLabel(self, profilerActualDict, nQuery, deltaTuple, attr=None):
+
+        if attr == None:
+            attr = self.attr
 
-        label = self.attr['label']
+        label = attr['label']
         label = label.strip(' ')
 
-        tag = getTag(self.attr, False)
+        tag = getTag(attr, False)
 
-        retLabel = self.constructLabel(tag, label, profilerActualDict, nQuery, deltaTuple)
+        retLabel = self.constructLabel(tag, label, profilerActualDict, nQuery, deltaTuple, attr=attr)
 
-        if 'tag' not in self.attr.keys():
-            self.attr['tag'] = self.attr['label']
+        if 'tag' not in attr.keys():
+            attr['tag'] = attr['label']
             
-        self.attr['label'] = retLabel
+        attr['label'] = retLabel
+
+    #------------------------------------------------------------
+    # Set the depth, shape and arrowhead of this node, in the same way
+    # that setDepth(), setShape() and setArrowhead() would
+    #------------------------------------------------------------
+
+    def setStructure(self, depth, shape, arrowhead):
+
+        if 'defDepth' not in self.node_attr:
+            self.depth = depth
+        else:
+            self.depth = self.node_attr['defDepth']
+
+        if 'shape' not in self.node_attr:
+            self.attr['shape'] = shape
+        else:
+            self.attr['shape'] = self.node_attr['shape']
+
+        self.attr['arrowhead'] = arrowhead
 
     def grayOut(self):
         self.setAllAttr('color', 'gray')
@@ -413,9 +790,20 @@ class DiGraph(Node):
         self.dg   = gv.Digraph('root', format=outputFormat)
         self.node_attr = {'depth':0, 'frac':-1}
         self.edges = []
+
+        # Index of sanitized tag -> [node, parent, index], maintained
+        # by append() for every node attached to this graph
+
+        self.graph = self
+        self.tagIndex = {}
         self.profilerSelfDict     = {}
         self.profilerBaselineDict = {}
         self.profilerActualDict   = {}
+        self.profilerLabels       = None
+        self.profilerUsec         = None
+        self.profilerCount        = None
+        self.profilerCorrUsec     = None
+        self.profilerFrac         = None
         self.totalTime = 0
         self.usecPerCount = 0
         self.nOp = 0
@@ -423,6 +811,15 @@ class DiGraph(Node):
         self.deltaFrac = False
         self.refUsec = 0.0
         self.threshold = 1000
+        self.padToDepth = False
+        self.fastDot = False
+        self.incremental = False
+        self.structure = None
+        self.labelCache = {}
+        self.edgeLabelCache = {}
+        self.dotQuoted = {}
+        self.nElided = 0
+        self.layoutCacheDir = None
 
     #------------------------------------------------------------
     # Ingest simple profiler output, with specified label indicating the total time
@@ -434,6 +831,15 @@ class DiGraph(Node):
                              clientCompFileName, profilerBaseFileName,
                              totalLabel):
 
+        #------------------------------------------------------------
+        # Each ingest replaces the previous profile, so that labels
+        # missing from these files don't keep earlier numbers
+        #------------------------------------------------------------
+
+        self.profilerActualDict   = {}
+        self.profilerBaselineDict = {}
+        self.profilerSelfDict     = {}
+
         #------------------------------------------------------------
         # If a comparison file was given, parse it now
         #------------------------------------------------------------
@@ -461,37 +867,200 @@ class DiGraph(Node):
 
         # First correct the total time for the time spent profiling
 
-        print 'Total (uncorrected) usec = ' + str(self.totalUsec)
-        print 'Total count              = ' + str(self.totalCount)
-        print 'usec per count           = ' + str(self.usecPerCount)
+        instrumentation.record('uncorrectedTotalUsec', self.totalUsec)
+        instrumentation.record('totalCount',           self.totalCount)
+        instrumentation.record('usecPerCount',         self.usecPerCount)
 
         self.totalUsec -= (self.totalCount * self.usecPerCount)
 
-        print 'Total (corrected) usec   = ' + str(self.totalUsec)
+        instrumentation.record('totalUsec', self.totalUsec)
 
         if clientCompFileName != None:
-            print 'Comp time (usec)         = ' + str(compDict['firstusec'])
+            instrumentation.record('compUsec', compDict['firstusec'])
         
         #------------------------------------------------------------
         # Next, for each label encountered, subtract off baselines,
         # correct for profiling, and convert to a fraction of total time
         #------------------------------------------------------------
 
-        for key in self.profilerActualDict.keys():
-            base = 0.0
-            if key in self.profilerBaselineDict.keys():
-                if isinstance(self.profilerBaselineDict[key], dict):
-                    base  = self.profilerBaselineDict[key]['usec']
-                else:
-                    base = 0.0
+        self.correctProfile()
+
+    #------------------------------------------------------------
+    # Follow a live profiler output file, re-rendering to name each
+    # time a new record has arrived and at least interval seconds
+    # have passed since the last render.  The file is polled every
+    # pollInterval seconds, and only what was appended is read.  Each
+    # record updates profilerActualDict in place, and the digraph is
+    # switched to incremental mode so that only nodes whose numbers
+    # changed are rebuilt.  Returns after maxRenders renders (or
+    # never, if maxRenders is None)
+    #------------------------------------------------------------
+
+    def followProfilerOutput(self, fileName, name,
+                             clientBaseFileName=None, serverBaseFileName=None,
+                             profilerBaseFileName=None, totalLabel=None,
+                             interval=10.0, pollInterval=1.0, maxRenders=None):
+
+        self.calculateUsecPerCount(profilerBaseFileName)
+        self.calculateBaselines(clientBaseFileName, serverBaseFileName)
+        self.incremental = True
+
+        follower   = ProfilerFollower(fileName)
+        nRender    = 0
+        lastRender = None
+        pending    = False
+
+        while maxRenders == None or nRender < maxRenders:
+
+            record = follower.poll()
+            if record != None:
+                self.ingestProfilerRecord(record, totalLabel)
+                pending = True
+
+            if pending and (lastRender == None or time.time() - lastRender >= interval):
+                self.render(name)
+                lastRender = time.time()
+                nRender += 1
+                pending = False
+            else:
+                time.sleep(pollInterval)
+
+        return nRender
+
+    #------------------------------------------------------------
+    # Replace the actual profile with a record's columns (see
+    # readProfilerFile()), and recompute the corrected times
+    #------------------------------------------------------------
+
+    def ingestProfilerRecord(self, record, totalLabel):
 
-            if isinstance(self.profilerActualDict[key], dict):
-                usec  = self.profilerActualDict[key]['usec']
-                count = self.profilerActualDict[key]['count']
+        (labels, usec, counts, totalcount, firstusec) = record
 
-                self.profilerActualDict[key]['corrusec'] = (usec - base) - (self.usecPerCount * count)
-#                print 'UNCORR key = ' + key + ' val = ' + str(usec) + ' base = ' + str(base) + ' usecpercount = ' + str(self.usecPerCount) + ' count = ' + str(count) + ' CORR = ' + str(self.profilerActualDict[key]['corrusec'])
-                self.profilerActualDict[key]['frac'] = 100 * self.profilerActualDict[key]['corrusec']/self.totalUsec
+        for label, u, c in itertools.izip(labels, usec, counts):
+            entry = self.profilerActualDict.get(label)
+            if entry == None:
+                self.profilerActualDict[label] = {'usec': u, 'count': c}
+            else:
+                entry['usec']  = u
+                entry['count'] = c
+
+        self.totalCount = totalcount
+        if totalLabel == None:
+            self.totalUsec = firstusec
+        else:
+            self.totalUsec = self.profilerActualDict[totalLabel]['usec']
+        self.totalUsec -= (self.totalCount * self.usecPerCount)
+
+        self.correctProfile()
+
+    #------------------------------------------------------------
+    # Hold the actual and baseline profiles as aligned columns
+    # (profilerLabels, profilerUsec, profilerCount), and compute the
+    # baseline- and profiling-corrected times (profilerCorrUsec) and
+    # fractions of total time (profilerFrac) as array operations.
+    # The results are also stored back into profilerActualDict, where
+    # the label code expects to find them
+    #------------------------------------------------------------
+
+    def correctProfile(self):
+
+        numpy = loadNumpy()
+
+        with instrumentation.phase('correct'):
+            (self.profilerLabels, self.profilerUsec, self.profilerCount) = profilerColumns(self.profilerActualDict)
+            (baseLabels, baseUsec, baseCount) = profilerColumns(self.profilerBaselineDict)
+
+            base = numpy.zeros(len(self.profilerLabels))
+            if len(baseLabels) > 0:
+                common, iActual, iBase = numpy.intersect1d(self.profilerLabels, baseLabels, assume_unique=True, return_indices=True)
+                base[iActual] = baseUsec[iBase]
+
+            self.profilerCorrUsec = (self.profilerUsec - base) - (self.usecPerCount * self.profilerCount)
+            self.profilerFrac     = 100 * self.profilerCorrUsec/self.totalUsec
+
+            for key, corrusec, frac in itertools.izip(self.profilerLabels.tolist(), self.profilerCorrUsec.tolist(), self.profilerFrac.tolist()):
+                self.profilerActualDict[key]['corrusec'] = corrusec
+                self.profilerActualDict[key]['frac']     = frac
+
+    #------------------------------------------------------------
+    # Ingest any number of profiler samples (from every node of a
+    # cluster, or from repeated runs), parsed in parallel.  Each
+    # sample is a file name or a tuple of file names (see
+    # parseProfilerSample()), and is corrected for baselines and
+    # profiling separately.  Each label's corrected time is then the
+    # given statistic (mean, median or p95) of its samples, and the
+    # statistics named in stats are stored with it for the labels to
+    # show.  Samples in which a label doesn't appear are ignored for
+    # that label
+    #------------------------------------------------------------
+
+    def ingestProfilerSamples(self, samples,
+                              clientBaseFileName, serverBaseFileName,
+                              profilerBaseFileName, totalLabel,
+                              stat='mean', stats=('median', 'p95', 'spread'),
+                              nWorker=None):
+
+        numpy = loadNumpy()
+
+        self.calculateUsecPerCount(profilerBaseFileName)
+        self.calculateBaselines(clientBaseFileName, serverBaseFileName)
+
+        sampleDicts = parseProfilerSamples(samples, nWorker)
+
+        # Corrected total time and count of each sample
+
+        totalCount = numpy.array([sampleDict['totalcount'] for sampleDict in sampleDicts], dtype=float)
+        if totalLabel == None:
+            totalUsec = numpy.array([sampleDict['firstusec'] for sampleDict in sampleDicts], dtype=float)
+        else:
+            totalUsec = numpy.array([sampleDict[totalLabel]['usec'] for sampleDict in sampleDicts], dtype=float)
+        totalUsec -= totalCount * self.usecPerCount
+
+        # Label x sample matrices of times and counts, nan where a
+        # sample lacks a label
+
+        columns = [profilerColumns(sampleDict) for sampleDict in sampleDicts]
+        (labels, rowList) = alignLabels([column[0] for column in columns])
+
+        usec  = numpy.full((len(labels), len(columns)), numpy.nan)
+        count = numpy.full((len(labels), len(columns)), numpy.nan)
+        for i in range(len(columns)):
+            usec[rowList[i], i]  = columns[i][1]
+            count[rowList[i], i] = columns[i][2]
+
+        (baseLabels, baseUsec, baseCount) = profilerColumns(self.profilerBaselineDict)
+        base = numpy.zeros(len(labels))
+        if len(baseLabels) > 0:
+            common, iActual, iBase = numpy.intersect1d(labels, baseLabels, assume_unique=True, return_indices=True)
+            base[iActual] = baseUsec[iBase]
+
+        corrUsec = (usec - base[:, numpy.newaxis]) - (self.usecPerCount * count)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            statValues = {'mean':   numpy.nanmean(corrUsec, axis=1),
+                          'median': numpy.nanmedian(corrUsec, axis=1),
+                          'p95':    numpy.nanpercentile(corrUsec, 95, axis=1),
+                          'spread': numpy.nanstd(corrUsec, axis=1)}
+            self.profilerUsec  = numpy.nanmean(usec, axis=1)
+            self.profilerCount = numpy.nanmean(count, axis=1)
+
+        self.totalCount       = totalCount.mean()
+        self.totalUsec        = totalUsec.mean()
+        self.profilerLabels   = labels
+        self.profilerCorrUsec = statValues[stat]
+        self.profilerFrac     = 100 * self.profilerCorrUsec/self.totalUsec
+
+        nSample = (~numpy.isnan(usec)).sum(axis=1)
+
+        self.profilerActualDict = {}
+        for i in range(len(labels)):
+            self.profilerActualDict[labels[i]] = {'usec':     self.profilerUsec[i],
+                                                  'count':    self.profilerCount[i],
+                                                  'corrusec': self.profilerCorrUsec[i],
+                                                  'frac':     self.profilerFrac[i],
+                                                  'nsample':  nSample[i],
+                                                  'stats':    [(name, statValues[name][i]) for name in stats]}
 
     #------------------------------------------------------------
     # If a non-null fileName was passed, it should contain a measure
@@ -547,15 +1116,67 @@ class DiGraph(Node):
         if totalLabel != None:
             self.totalUsec = self.profilerActualDict[totalLabel]['usec']
 
-        print 'Actual dict = ' + str(self.profilerActualDict)
+        instrumentation.record('nLabel', len(self.profilerActualDict))
+
+    #------------------------------------------------------------
+    # Maintain the tag index.  indexSubtree() registers node (and
+    # everything below it) as the child of parent at position index,
+    # and marks the subtree as belonging to this graph, so that
+    # subsequent appends to any of its nodes are indexed as well
+    #------------------------------------------------------------
+
+    def indexSubtree(self, node, parent, index):
+        self.structure = None
+        stack = [(node, parent, index)]
+        while len(stack) > 0:
+            (node, parent, index) = stack.pop()
+            node.graph = self
+            tag = getTag(node.attr)
+            entry = self.tagIndex.get(tag)
+            if entry == None or entry[0] is node:
+                self.tagIndex[tag] = [node, parent, index]
+            for i in range(len(node.nodes)-1, -1, -1):
+                stack.append((node.nodes[i], node, i))
+
+    #------------------------------------------------------------
+    # Re-register the children of parent after an insertion has
+    # shifted their positions
+    #------------------------------------------------------------
+
+    def reindexChildren(self, parent):
+        self.structure = None
+        for i in range(len(parent.nodes)):
+            child = parent.nodes[i]
+            entry = self.tagIndex.get(getTag(child.attr))
+            if entry == None:
+                self.indexSubtree(child, parent, i)
+            elif entry[0] is child:
+                entry[1] = parent
+                entry[2] = i
+
+    def findNode(self, tag):
+        entry = self.tagIndex.get(sanitizeForGraphviz(tag))
+        if entry == None:
+            return None
+        return entry[0]
+
+    def findParentOfNode(self, tag):
+        entry = self.tagIndex.get(sanitizeForGraphviz(tag))
+        if entry == None:
+            return [None, 0]
+        return [entry[1], entry[2]]
 
     def setAttr(self, nodeName, attr, val):
-        for node in self.nodes:
-            node.setAttr(nodeName, attr, val)
+        node = self.findNode(nodeName)
+        if node != None:
+            node.attr[attr] = val
+            self.labelCache.pop(node, None)
 
     def setNodeAttr(self, nodeName, attr, val):
-        for node in self.nodes:
-            node.setNodeAttr(nodeName, attr, val)
+        node = self.findNode(nodeName)
+        if node != None:
+            node.node_attr[attr] = val
+            self.structure = None
             
     def setShape(self):
         for node in self.nodes:
@@ -593,83 +1214,637 @@ class DiGraph(Node):
             ret += '</TABLE>>'
         return ret
 
+    #------------------------------------------------------------
+    # Render the graph to file name.  build() does all of the work
+    # up to (but not including) running graphviz.  With
+    # layoutCacheDir set, the digraph is rendered incrementally (see
+    # renderCachedLayout()) and can be re-rendered; otherwise only
+    # an incremental digraph can be rendered more than once
+    #------------------------------------------------------------
+
     def render(self, name):
-        self.setDepth()
-#        maxDepth = self.getMaxDepth()
-#        self.appendInvisibleNodesToDepth(maxDepth)
-#        self.setDepth()
-        self.setShape()
-        self.setArrowhead()
-        self.setLabels(self.profilerActualDict, self.nOp, (self.isDelta, self.deltaFrac, self.refUsec, self.threshold))
-        self.constructSubgraphs()
-        self.connectNodes(self.isDelta)
-        self.renderEdgeLabels()
-        self.connectEdges()
-        self.dg.render(filename=name)
+        with instrumentation.phase('render'):
+            if self.layoutCacheDir != None:
+                rendered = self.renderCachedLayout(name)
+            elif self.fastDot or self.incremental:
+                with open(name, 'w') as f:
+                    self.writeDot(f)
+                with instrumentation.phase('dot'):
+                    rendered = gv.render(self.dg.engine, self.dg.format, name)
+            else:
+                self.build()
+                with instrumentation.phase('dot'):
+                    rendered = self.dg.render(filename=name)
+            if self.dg.format == 'svg':
+                inlinePieGlyphs(rendered)
+        instrumentation.renderDone()
+        return rendered
 
-    def printDeepestNodes(self):
-        for node in self.nodes:
-            maxNode = node.getDeepestNode()
-            print 'Deepest node for ' + node.attr['label'] + ' = ' + maxNode.attr['label'] + ' at depth ' + str(maxNode.node_attr['depth'])
-            maxNode.appendInvisibleNode()
+    #------------------------------------------------------------
+    # Render with a layout cache in layoutCacheDir.  Layouts are
+    # cached under a hash of the graph's structure (see layoutKey()),
+    # so a graph whose nodes and edges haven't changed -- only its
+    # profile numbers -- reuses the node positions of an earlier
+    # render.  On a miss, dot lays the graph out as usual, and also
+    # writes the positions (in plain format) for the cache.  On a hit,
+    # the positions are pinned on the nodes, and neato -n renders the
+    # graph without laying it out again.  The digraph is switched to
+    # incremental mode, so that it can be rendered more than once
+    #------------------------------------------------------------
 
-    def appendInvisibleNodesToDepth(self, depth):
-        for node in self.nodes:
-            deepestNode = node.getDeepestNode()
-            deepestDepth = deepestNode.node_attr['depth']
-            while deepestDepth < depth:
-                deepestNode = deepestNode.appendInvisibleNode()
-                deepestDepth = deepestNode.node_attr['depth']
-                
-    def setDepth(self):
-        for node in self.nodes:
-            node.setDepth(0)
+    def renderCachedLayout(self, name):
 
-    def constructSubgraph(self, depth):
-        nodeList = self.getNodesAtDepth(depth, [])
-        if len(nodeList) > 0:
-            sg = gv.Digraph('subgraph_' + str(depth))
-            sg.graph_attr['rank'] = 'same'
+        self.incremental = True
 
-            for node in nodeList:
-#                print 'depth = ' + str(depth) + ' tag = ' + getTag(node.attr) + ' node.depth = ' + str(node.node_attr['depth'])
-                sg.node(getTag(node.attr), **node.attr)
+        key       = self.layoutKey()
+        plainFile = os.path.join(self.layoutCacheDir, key + '.plain')
 
-            self.dg.subgraph(sg)
+        positions = None
+        if os.path.isfile(plainFile):
+            positions = readPlainPositions(plainFile)
+            for node in self.walk(False):
+                pos = positions.get(getTag(node.attr))
+                if pos != None:
+                    node.attr['pos'] = pos
 
-            return True
+        with open(name, 'w') as f:
+            self.writeDot(f)
+
+        (dirName, fileName) = os.path.split(name)
+        if positions != None:
+            (cmd, rendered) = gv.backend.command('neato', self.dg.format, fileName)
+            cmd.insert(1, '-n')
         else:
-            return False
+            (cmd, rendered) = gv.backend.command(self.dg.engine, self.dg.format, fileName)
+            cmd.insert(-2, '-Tplain')
 
-    def constructSubgraphs(self):
-        cont = True
-        depth = 0
-        while cont:
-            cont = self.constructSubgraph(depth)
-            depth = depth + 1
+        with instrumentation.phase('dot'):
+            gv.backend.run(cmd, capture_output=True, cwd=dirName or None, check=True)
 
-    def connectNodes(self, delta=False):
-        for node in self.nodes:
-            node.connectNodes(self.dg, delta)
+        if positions == None:
+            if not os.path.isdir(self.layoutCacheDir):
+                os.makedirs(self.layoutCacheDir)
+            os.rename(name + '.plain', plainFile)
 
-    def renderEdgeLabels(self):
-        for edge in self.edges:
-            attr = edge[2]
-            if 'label' in attr.keys():
-                tag = attr['label'].strip(' ')
-                label = attr['label']
-            else:
-                tag = ' '
-                label = ' '
+        return os.path.join(dirName, rendered)
 
-            if 'color' in attr.keys():
-                color = attr['color']
-            else:
-                color = None
+    #------------------------------------------------------------
+    # A hash of everything that determines the layout: the node tags
+    # at each depth, the tree, padding and user-defined edges, and the
+    # engine and graph attributes
+    #------------------------------------------------------------
+
+    def layoutKey(self):
+        (layers, entries) = self.getStructure()
+        key = hashlib.sha1()
+        key.update(self.dg.engine + '\n' + repr(sorted(self.dg.graph_attr.items())) + '\n')
+        for layer in layers:
+            key.update(' '.join([getTag(node.attr) for node in layer]) + '\n')
+        for entry in entries:
+            if entry[0] == 'tree':
+                key.update('tree ' + getTag(entry[1].attr) + ' ' + getTag(entry[2].attr) + '\n')
+            else:
+                key.update(' '.join(entry) + '\n')
+        for edge in self.edges:
+            key.update('edge ' + sanitizeForGraphviz(edge[0]) + ' ' + sanitizeForGraphviz(edge[1]) + '\n')
+        return key.hexdigest()
+
+    #------------------------------------------------------------
+    # Start rendering the graph to file name, without waiting for
+    # graphviz.  The DOT source is written here, and dot is started
+    # as a subprocess; the returned RenderJob tracks it
+    #------------------------------------------------------------
+
+    def renderAsync(self, name, timeout=None):
+        start = time.time()
+        if self.fastDot or self.incremental:
+            with open(name, 'w') as f:
+                self.writeDot(f)
+        else:
+            self.build()
+            self.dg.save(filename=name)
+        return RenderJob(name, self.dg.engine, self.dg.format, time.time() - start, timeout)
+
+    #------------------------------------------------------------
+    # The instrumentation report (see Instrumentation.report())
+    #------------------------------------------------------------
+
+    def report(self):
+        return instrumentation.report()
+
+    #------------------------------------------------------------
+    # Compute the structure of the graph in a single iterative
+    # traversal.  Each node's depth, shape and arrowhead are set when
+    # its parent is visited; nodes are bucketed by depth on visit (in
+    # the same order getNodesAtDepth() would find them), and edges
+    # are listed in the order connectNodes() would emit them.
+    #
+    # Returns the list of nodes at each depth, and a list of edge
+    # entries, either ('tree', parent, child) or ('invis', tail, head).
+    # The result is cached until nodes or edges are added
+    #------------------------------------------------------------
+
+    def getStructure(self):
+
+        if self.structure != None:
+            return self.structure
+
+        with instrumentation.phase('structure'):
+            if self.padToDepth:
+                self.setDepth()
+                self.appendInvisibleNodesToDepth()
+
+            buckets = {}
+            entries = []
+
+            for node in self.nodes:
+                node.setStructure(0, 'ellipse', 'none')
+
+            stack = []
+            for i in range(len(self.nodes)-1, -1, -1):
+                stack.append(('enter', self.nodes[i], 0))
+
+            while len(stack) > 0:
+                item = stack.pop()
+
+                if item[0] == 'enter':
+                    (kind, node, depth) = item
+                    buckets.setdefault(node.depth, []).append(node)
+
+                    childDepths = []
+                    for i in range(len(node.nodes)):
+                        if node.rank == 'same':
+                            childDepths.append(depth + 1)
+                        else:
+                            childDepths.append(depth + i + 1)
+                        node.nodes[i].setStructure(childDepths[i], 'rectangle', 'normal')
+
+                    stack.append(('exit', node))
+                    for i in range(len(node.nodes)-1, -1, -1):
+                        stack.append(('enter', node.nodes[i], childDepths[i]))
+                        stack.append(('tree', node, node.nodes[i]))
+
+                elif item[0] == 'tree':
+                    entries.append(item)
+
+                else:
+                    (kind, node) = item
+                    for i in range(1, len(node.nodes)):
+                        entries.append(('invis', getTag(node.nodes[i-1].attr), getTag(node.nodes[i].attr)))
+
+            layers = []
+            while len(layers) in buckets:
+                layers.append(buckets[len(layers)])
+
+            self.structure = (layers, entries)
+            self.labelCache = {}
+            return self.structure
+
+    #------------------------------------------------------------
+    # Turn the edge entries from getStructure() into (tail, head,
+    # attr) edges.  attrOf(node) returns the rendered attributes of a
+    # node.  As in connectNodes(), the attributes of the edges from a
+    # parent to its children accumulate from one child to the next
+    #------------------------------------------------------------
+
+    def resolveEdges(self, entries, attrOf):
+        edges  = []
+        shared = {}
+        for entry in entries:
+            if entry[0] == 'tree':
+                (kind, parent, child) = entry
+                parentAttr = attrOf(parent)
+                childAttr  = attrOf(child)
+                attr = shared.setdefault(parent, {})
+                if self.isDelta:
+                    attr['color'] = 'gray'
+                if 'arrowhead' in parentAttr.keys():
+                    attr['arrowhead'] = parentAttr['arrowhead']
+                if 'color' in childAttr.keys() and childAttr['color'] == 'gray':
+                    attr['color'] = 'gray'
+                if 'pad' in child.node_attr:
+                    edges.append((getTag(parentAttr), getTag(childAttr), dict(attr, style='invis')))
+                else:
+                    edges.append((getTag(parentAttr), getTag(childAttr), dict(attr)))
+            else:
+                edges.append((entry[1], entry[2], {'color':'invis'}))
+        return edges
+
+    #------------------------------------------------------------
+    # Prepare the graph for rendering: compute the structure, then
+    # render every label in place.  The output is identical to
+    # buildMultiPass().
+    #
+    # Returns the list of nodes at each depth, and the list of
+    # (tail, head, attr) edges, including user-defined edges
+    #------------------------------------------------------------
+
+    def prepareGraph(self):
+
+        self.structure = None
+        (layers, entries) = self.getStructure()
+
+        deltaTuple = (self.isDelta, self.deltaFrac, self.refUsec, self.threshold)
+        with instrumentation.phase('labels'):
+            for layer in layers:
+                for node in layer:
+                    node.renderLabel(self.profilerActualDict, self.nOp, deltaTuple)
+
+        with instrumentation.phase('edges'):
+            edges = self.resolveEdges(entries, lambda node: node.attr)
+
+            self.renderEdgeLabels()
+            edges.extend(self.crossEdges())
+
+        return (layers, edges)
+
+    #------------------------------------------------------------
+    # Incremental rendering.  Node attributes are never modified:
+    # rendered attributes (and the DOT line) of each node are cached
+    # in labelCache, keyed by the profile values the label depends
+    # on and by the node's own attributes (and annotation color), and
+    # only rebuilt when those change.  Edge labels are cached in
+    # edgeLabelCache in the same way
+    #------------------------------------------------------------
+
+    def profileKey(self, tag):
+        entry = self.profilerActualDict.get(tag)
+        if isinstance(entry, dict):
+            entry = (entry.get('frac'), entry.get('corrusec'), tuple(entry.get('stats', ())))
+        return (entry, self.nOp, self.isDelta, self.deltaFrac, self.refUsec, self.threshold)
+
+    def renderedNode(self, node):
+        key = (self.profileKey(getTag(node.attr, False)), sorted(node.attr.items()), node.node_attr.get('annotationcolor'))
+        cached = self.labelCache.get(node)
+        if cached == None or cached[0] != key:
+            attr = dict(node.attr)
+            with instrumentation.phase('labels'):
+                node.renderLabel(self.profilerActualDict, self.nOp, (self.isDelta, self.deltaFrac, self.refUsec, self.threshold), attr)
+            cached = (key, attr, '\t\t' + self.dotQuote(getTag(attr)) + self.dotAttrList(attr))
+            self.labelCache[node] = cached
+        return cached
+
+    def renderedEdges(self, attrOf):
+        edges = []
+        for i in range(len(self.edges)):
+            (head, tail, attr) = self.edges[i]
+            attr = dict(attr)
+
+            if 'label' in attr.keys():
+                tag = attr['label'].strip(' ')
+                label = attr['label']
+            else:
+                tag = ' '
+                label = ' '
+
+            if 'color' in attr.keys():
+                color = attr['color']
+            else:
+                color = None
+
+            key = (self.profileKey(tag), label, color, sorted(self.attr.items()), self.node_attr.get('annotationcolor'))
+            cached = self.edgeLabelCache.get(i)
+            if cached == None or cached[0] != key:
+                cached = (key, self.constructLabel(tag, label, self.profilerActualDict, self.nOp, (self.isDelta, self.deltaFrac, self.refUsec, self.threshold), color, dict(self.attr)))
+                self.edgeLabelCache[i] = cached
+            attr['label'] = cached[1]
+
+            if self.isDelta:
+                attr['color'] = 'gray'
+
+            for tag in (head, tail):
+                nodeAttr = attrOf(self.findNode(tag))
+                if 'color' in nodeAttr.keys() and nodeAttr['color'] == 'gray':
+                    attr['color'] = 'gray'
+
+            edges.append((sanitizeForGraphviz(head), sanitizeForGraphviz(tail), attr))
+        return edges
+
+    def writeDotIncremental(self, out):
+
+        (layers, entries) = self.getStructure()
+        attrOf = lambda node: self.renderedNode(node)[1]
+
+        lines = list(self.dg)
+        for line in lines[:-1]:
+            out.write(line + '\n')
+
+        for depth in range(len(layers)):
+            out.write('\tsubgraph subgraph_' + str(depth) + ' {\n\t\tgraph [rank=same]\n')
+            for node in layers[depth]:
+                out.write(self.renderedNode(node)[2] + '\n')
+            out.write('\t}\n')
+
+        with instrumentation.phase('edges'):
+            edges = self.resolveEdges(entries, attrOf)
+            edges.extend(self.renderedEdges(attrOf))
+
+        for (tail, head, attr) in edges:
+            out.write('\t' + self.dotQuote(tail) + ' -> ' + self.dotQuote(head) + self.dotAttrList(attr) + '\n')
+
+        out.write(lines[-1] + '\n')
+
+    #------------------------------------------------------------
+    # Build the graphviz.Digraph for this graph
+    #------------------------------------------------------------
+
+    def build(self):
+
+        checkPieCache()
+        (layers, edges) = self.prepareGraph()
+
+        with instrumentation.phase('subgraphs'):
+            for depth in range(len(layers)):
+                sg = gv.Digraph('subgraph_' + str(depth))
+                sg.graph_attr['rank'] = 'same'
+                for node in layers[depth]:
+                    sg.node(getTag(node.attr), **node.attr)
+                self.dg.subgraph(sg)
+
+            for (tail, head, attr) in edges:
+                self.dg.edge(tail, head, **attr)
+
+    #------------------------------------------------------------
+    # DOT quoting, as graphviz.Digraph does it.  Quoted identifiers
+    # and attribute values are cached, since most of them repeat;
+    # labels are unique, so are quoted as needed
+    #------------------------------------------------------------
+
+    def dotQuote(self, val):
+        if val not in self.dotQuoted:
+            self.dotQuoted[val] = gv.lang.quote(val)
+        return self.dotQuoted[val]
+
+    def dotAttrList(self, attr):
+        items = []
+        if attr.get('label') != None:
+            items.append('label=' + gv.lang.quote(attr['label']))
+        for key in sorted(attr.keys()):
+            if key != 'label' and attr[key] != None:
+                items.append(self.dotQuote(key) + '=' + self.dotQuote(attr[key]))
+        if len(items) == 0:
+            return ''
+        return ' [' + ' '.join(items) + ']'
+
+    #------------------------------------------------------------
+    # Write this graph as DOT to the file-like object out, bypassing
+    # the graphviz.Digraph calls.  The text is identical to what
+    # build() followed by graphviz would save.  With incremental
+    # set, only labels whose profile values changed are rebuilt
+    #------------------------------------------------------------
+
+    def writeDot(self, out):
+
+        # Cached labels refer to charts that may have been deleted
+
+        if checkPieCache():
+            self.labelCache = {}
+            self.edgeLabelCache = {}
+
+        with instrumentation.phase('source'):
+            if self.incremental:
+                self.writeDotIncremental(out)
+            else:
+                self.writeDotFull(out)
+
+    def writeDotFull(self, out):
+
+        (layers, edges) = self.prepareGraph()
+        quote    = self.dotQuote
+        attrList = self.dotAttrList
+
+        # Header, graph attributes and anything added to self.dg directly
+
+        lines = list(self.dg)
+        for line in lines[:-1]:
+            out.write(line + '\n')
+
+        for depth in range(len(layers)):
+            out.write('\tsubgraph subgraph_' + str(depth) + ' {\n\t\tgraph [rank=same]\n')
+            for node in layers[depth]:
+                out.write('\t\t' + quote(getTag(node.attr)) + attrList(node.attr) + '\n')
+            out.write('\t}\n')
+
+        for (tail, head, attr) in edges:
+            out.write('\t' + quote(tail) + ' -> ' + quote(head) + attrList(attr) + '\n')
+
+        out.write(lines[-1] + '\n')
+
+    #------------------------------------------------------------
+    # Graphviz-free exports of the profiled tree, each written to the
+    # file-like object out in a single pass.  Times are per operation
+    # (corrusec / nOp), in usec.  Padding nodes are skipped
+    #------------------------------------------------------------
+
+    def exportEntry(self, node):
+        if node.extra != None and 'pad' in node.extra:
+            return None
+        entry = self.profilerActualDict.get(getTag(node.attr, False))
+        if isinstance(entry, dict):
+            return entry
+        return {}
+
+    #------------------------------------------------------------
+    # Write the tree as nested JSON, in the name/value/children form
+    # flame graph viewers read.  value is the node's (inclusive) time,
+    # and frac and count are included where the profile has them
+    #------------------------------------------------------------
+
+    def writeJson(self, out):
+
+        nOp = self.nOp or 1
+
+        out.write('{"name": "root", "children": [')
+        stack = [iter(self.nodes)]
+        first = [True]
+        while len(stack) > 0:
+            node = next(stack[-1], None)
+            if node == None:
+                stack.pop()
+                first.pop()
+                out.write(']}')
+                continue
+
+            entry = self.exportEntry(node)
+            if entry == None:
+                continue
+
+            if not first[-1]:
+                out.write(', ')
+            first[-1] = False
+
+            fields = ['{"name": ' + json.encoder.encode_basestring_ascii(getTag(node.attr, False))]
+            if 'corrusec' in entry:
+                fields.append('"value": ' + repr(float(entry['corrusec']) / nOp))
+            for key in ['frac', 'count']:
+                if key in entry:
+                    fields.append('"' + key + '": ' + repr(float(entry[key])))
+            fields.append('"children": [')
+            out.write(', '.join(fields))
+
+            stack.append(iter(node.nodes))
+            first.append(True)
+
+        out.write('\n')
+
+    #------------------------------------------------------------
+    # Write the tree in the folded-stack format of flame graph tools:
+    # one 'module;fn1;fn2 usec' line per node with self time, where a
+    # node's self time is its time less that of its nearest profiled
+    # descendants (looking through unprofiled nodes in between)
+    #------------------------------------------------------------
+
+    def writeFolded(self, out):
+
+        nOp = self.nOp or 1
+
+        # First, the self time of each profiled node: every profiled
+        # node subtracts its time from its nearest profiled ancestor
+
+        selfUsec = {}
+        stack = [(node, None) for node in self.nodes]
+        while len(stack) > 0:
+            (node, ancestor) = stack.pop()
+
+            entry = self.exportEntry(node)
+            if entry == None:
+                continue
+
+            if 'corrusec' in entry:
+                selfUsec[node] = entry['corrusec']
+                if ancestor != None:
+                    selfUsec[ancestor] -= entry['corrusec']
+                ancestor = node
+
+            for child in node.nodes:
+                stack.append((child, ancestor))
+
+        # names holds the frames of the current path, so that a path
+        # is only joined for the nodes that write a line
+
+        names = []
+        stack = [(self.nodes[i], 0) for i in range(len(self.nodes)-1, -1, -1)]
+        while len(stack) > 0:
+            (node, depth) = stack.pop()
+
+            entry = self.exportEntry(node)
+            if entry == None:
+                continue
+
+            del names[depth:]
+            names.append(getTag(node.attr, False).replace(';', '_'))
+
+            if node in selfUsec:
+                usec = int(round(float(selfUsec[node]) / nOp))
+                if usec > 0:
+                    out.write(';'.join(names) + ' ' + str(usec) + '\n')
+
+            for i in range(len(node.nodes)-1, -1, -1):
+                stack.append((node.nodes[i], depth + 1))
+
+    #------------------------------------------------------------
+    # The original multi-pass preparation, one tree walk per step
+    #------------------------------------------------------------
+
+    def buildMultiPass(self):
+        with instrumentation.phase('structure'):
+            self.setDepth()
+            if self.padToDepth:
+                self.appendInvisibleNodesToDepth(self.getMaxDepth())
+                self.setDepth()
+            self.setShape()
+            self.setArrowhead()
+        with instrumentation.phase('labels'):
+            self.setLabels(self.profilerActualDict, self.nOp, (self.isDelta, self.deltaFrac, self.refUsec, self.threshold))
+        with instrumentation.phase('subgraphs'):
+            self.constructSubgraphs()
+        with instrumentation.phase('edges'):
+            self.connectNodes(self.isDelta)
+            self.renderEdgeLabels()
+            self.connectEdges()
+
+    def printDeepestNodes(self):
+        for node in self.nodes:
+            maxNode = node.getDeepestNode()
+            print 'Deepest node for ' + node.attr['label'] + ' = ' + maxNode.attr['label'] + ' at depth ' + str(maxNode.node_attr['depth'])
+            maxNode.appendInvisibleNode()
+
+    #------------------------------------------------------------
+    # Pad every module with a chain of invisible nodes below its
+    # deepest node, down to depth (by default, the maximum depth of
+    # the graph), so that modules line up.  Depths must already be
+    # set; this is linear in the number of nodes plus padding nodes
+    #------------------------------------------------------------
+
+    def appendInvisibleNodesToDepth(self, depth=None):
+        table = self.getSubtreeDepths()
+        if depth == None:
+            depth = table[self][0]
+        for node in self.nodes:
+            (deepestDepth, deepestNode) = table[node]
+            name = getTag(deepestNode.attr, False)
+            for i in range(1, depth - deepestDepth + 1):
+                deepestNode = deepestNode.appendInvisibleNode(name + '_sub' + str(i))
+                
+    def setDepth(self):
+        for node in self.nodes:
+            node.setDepth(0)
+
+    def constructSubgraph(self, depth):
+        nodeList = self.getNodesAtDepth(depth, [])
+        if len(nodeList) > 0:
+            sg = gv.Digraph('subgraph_' + str(depth))
+            sg.graph_attr['rank'] = 'same'
+
+            for node in nodeList:
+#                print 'depth = ' + str(depth) + ' tag = ' + getTag(node.attr) + ' node.depth = ' + str(node.node_attr['depth'])
+                sg.node(getTag(node.attr), **node.attr)
+
+            self.dg.subgraph(sg)
+
+            return True
+        else:
+            return False
+
+    def constructSubgraphs(self):
+        cont = True
+        depth = 0
+        while cont:
+            cont = self.constructSubgraph(depth)
+            depth = depth + 1
+
+    def connectNodes(self, delta=False):
+        for node in self.nodes:
+            node.connectNodes(self.dg, delta)
+
+    def renderEdgeLabels(self):
+        for edge in self.edges:
+            attr = edge[2]
+            if 'label' in attr.keys():
+                tag = attr['label'].strip(' ')
+                label = attr['label']
+            else:
+                tag = ' '
+                label = ' '
+
+            if 'color' in attr.keys():
+                color = attr['color']
+            else:
+                color = None
 
             attr['label'] = self.constructLabel(tag, label, self.profilerActualDict, self.nOp, (self.isDelta, self.deltaFrac, self.refUsec, self.threshold), color)
 
     def connectEdges(self):
+        for (tail, head, attr) in self.crossEdges():
+            self.dg.edge(tail, head, **attr)
+
+    #------------------------------------------------------------
+    # Return the user-defined edges as (tail, head, attr), grayed out
+    # in delta mode or if either end is gray
+    #------------------------------------------------------------
+
+    def crossEdges(self):
+        edges = []
         for edge in self.edges:
             if self.isDelta:
                 edge[2]['color'] = 'gray'
@@ -682,15 +1857,628 @@ class DiGraph(Node):
             if 'color' in node2.attr.keys() and node2.attr['color'] == 'gray':
                 edge[2]['color'] = 'gray'
 
-            self.dg.edge(sanitizeForGraphviz(edge[0]), sanitizeForGraphviz(edge[1]), **edge[2])
+            edges.append((sanitizeForGraphviz(edge[0]), sanitizeForGraphviz(edge[1]), edge[2]))
+        return edges
 
     def edge(self, head, tail, attr={}):
-        self.edges.append((head, tail, attr))
+        self.edges.append((head, tail, dict(attr)))
+
+    #------------------------------------------------------------
+    # Build the tree from (parent, child) label pairs, in a single
+    # pass using the tag index.  A child whose parent is None hangs
+    # off its module node ('module' for 'module:fn'), which is
+    # created and appended to the digraph as needed; labels without
+    # a module are modules themselves.  Parents that haven't been
+    # seen yet are created the same way.  A child that is already in
+    # the tree (a function with more than one caller) is connected to
+    # any further callers by an edge instead; a recursive call is a
+    # self edge.  Repeated pairs are only placed (or connected) once.
+    #
+    # With no calls, every label in profilerActualDict (except those
+    # in exclude) is placed under its module
+    #------------------------------------------------------------
+
+    def buildCallGraph(self, calls=None, exclude=()):
+
+        if calls == None:
+            calls = [(None, label) for label in sorted(self.profilerActualDict.keys())
+                     if isinstance(self.profilerActualDict[label], dict) and label not in exclude]
+
+        edgeSet = set([(edge[0], edge[1]) for edge in self.edges])
+
+        for (parent, child) in calls:
+
+            if parent == None:
+                self.placeCall(child)
+                continue
+
+            # Place the parent first: for a recursive call, that also
+            # places the child
+
+            parentNode = self.placeCall(parent)
+            entry = self.tagIndex.get(sanitizeForGraphviz(child))
+            if entry == None:
+                parentNode.append({'label': child})
+            elif entry[1] is not parentNode and (parent, child) not in edgeSet:
+                self.edge(parent, child)
+                edgeSet.add((parent, child))
+
+        return self
+
+    #------------------------------------------------------------
+    # Return the node for label, creating it under its module (and the
+    # module under the digraph) if it isn't in the tree yet
+    #------------------------------------------------------------
+
+    def placeCall(self, label):
+
+        entry = self.tagIndex.get(sanitizeForGraphviz(label))
+        if entry != None:
+            return entry[0]
+
+        substr = label.split(':', 1)
+        if len(substr) == 1:
+            return self.append({'label': label})
+        return self.placeCall(substr[0]).append({'label': label})
+
+    #------------------------------------------------------------
+    # Prune the tree to its hot paths, using the corrected fractions
+    # in profilerActualDict (their magnitude, in delta mode).  Below
+    # each module, any child whose subtree contains no node with at
+    # least minFrac percent of the time -- or, if topK is given, no
+    # node among the topK hottest -- is removed.  The children removed
+    # from each parent are replaced by a single summary node, whose
+    # profile entry is the sum of theirs, and edges to removed nodes
+    # are redirected to it.  Returns the number of nodes elided (also
+    # kept in nElided)
+    #------------------------------------------------------------
+
+    def prune(self, minFrac=1.0, topK=None):
+
+        nodes = list(self.walk(False))
+
+        # Each node's own fraction, and the hottest in its subtree
+
+        own    = {}
+        hot    = {}
+        parent = {}
+        for node in reversed(nodes):
+            entry = self.profilerActualDict.get(getTag(node.attr, False))
+            if isinstance(entry, dict):
+                frac = entry['frac']
+                if self.isDelta:
+                    frac = abs(frac)
+            else:
+                frac = -1
+            own[node] = frac
+            for child in node.nodes:
+                parent[child] = node
+                frac = max(frac, hot[child])
+            hot[node] = frac
+
+        # The topK hottest nodes, and every node on their paths
+
+        onPath = None
+        if topK != None:
+            onPath = set()
+            for node in heapq.nlargest(topK, nodes, key=own.get):
+                while node != None and node not in onPath:
+                    onPath.add(node)
+                    node = parent.get(node)
+
+        nElided = 0
+        elided  = {}
+        stack   = list(self.nodes)
+        while len(stack) > 0:
+            node = stack.pop()
+
+            # A summary left by an earlier prune is merged into the new one
+
+            summaryTag = getTag(node.attr, False) + ':elided'
+            kept       = []
+            collapsed  = []
+            for child in node.nodes:
+                if hot[child] >= minFrac and (onPath == None or child in onPath) and getTag(child.attr, False) != summaryTag:
+                    kept.append(child)
+                else:
+                    collapsed.append(child)
+
+            stack.extend(kept)
+
+            if len(collapsed) == 0 or (len(collapsed) == 1 and getTag(collapsed[0].attr, False) == summaryTag):
+                continue
+
+            summary = {}
+            nNode   = 0
+            for child in collapsed:
+                entry = self.profilerActualDict.get(getTag(child.attr, False))
+                if isinstance(entry, dict):
+                    for key in ['usec', 'count', 'corrusec', 'frac']:
+                        summary[key] = summary.get(key, 0) + entry.get(key, 0)
+                for removed in child.walk():
+                    elided[getTag(removed.attr)] = summaryTag
+                    self.tagIndex.pop(getTag(removed.attr), None)
+                    self.labelCache.pop(removed, None)
+                    if 'elided' in removed.node_attr:
+                        nNode += removed.node_attr['elided']
+                    else:
+                        nNode += 1
+                        nElided += 1
+
+            if len(summary) > 0:
+                self.profilerActualDict[summaryTag] = summary
+
+            node.nodes = kept
+            self.reindexChildren(node)
+            node.append({'label': str(nNode) + ' more', 'tag': summaryTag, 'style': 'dashed'}).node_attr['elided'] = nNode
+
+        # Redirect edges to elided nodes to their summaries, dropping
+        # any that end up connecting a node to itself
+
+        edges = []
+        for (tail, head, attr) in self.edges:
+            tail = elided.get(sanitizeForGraphviz(tail), tail)
+            head = elided.get(sanitizeForGraphviz(head), head)
+            if sanitizeForGraphviz(tail) != sanitizeForGraphviz(head):
+                edges.append((tail, head, attr))
+        self.edges = edges
+
+        self.structure = None
+        self.nElided  += nElided
+        return nElided
+
+#=======================================================================
+# Class for comparing any number of profiles.  Each run is held as a
+# column of per-operation corrected times, aligned by label into a
+# label x run matrix, so that deltas, ratios and regressions against
+# any baseline run are computed as array operations, and each
+# comparison can be rendered into a digraph without re-parsing
+#=======================================================================
+
+class ProfileComparison(object):
+
+    def __init__(self):
+        self.runNames = []
+        self.runs     = []
+        self.labels   = None
+        self.usec     = None
+        self.present  = None
+
+    #------------------------------------------------------------
+    # Add a run from a digraph that has already ingested a profile
+    #------------------------------------------------------------
+
+    def addRun(self, name, digraph):
+        nOp = digraph.nOp
+        if nOp == 0:
+            nOp = 1
+        self.runNames.append(name)
+        self.runs.append((digraph.profilerLabels, digraph.profilerCorrUsec / nOp))
+        self.labels = None
+
+    #------------------------------------------------------------
+    # Ingest a profile (with the same arguments as
+    # DiGraph.ingestProfilerOutput()) and add it as a run
+    #------------------------------------------------------------
+
+    def addProfile(self, name,
+                   clientFileName,     serverFileName,
+                   clientBaseFileName, serverBaseFileName,
+                   profilerBaseFileName, totalLabel, nOp=1):
+        digraph = DiGraph()
+        digraph.nOp = nOp
+        digraph.ingestProfilerOutput(clientFileName, serverFileName,
+                                     clientBaseFileName, serverBaseFileName,
+                                     None, profilerBaseFileName, totalLabel)
+        self.addRun(name, digraph)
+
+    #------------------------------------------------------------
+    # Build the label x run matrix of per-operation times.  Labels
+    # missing from a run count as zero time, and are marked absent
+    # in the present matrix
+    #------------------------------------------------------------
+
+    def matrix(self):
+        if self.labels is not None:
+            return (self.labels, self.usec)
+
+        numpy = loadNumpy()
+        (self.labels, rowList) = alignLabels([labels for (labels, usec) in self.runs])
+
+        self.usec    = numpy.zeros((len(self.labels), len(self.runs)))
+        self.present = numpy.zeros((len(self.labels), len(self.runs)), dtype=bool)
+        for i in range(len(self.runs)):
+            rows = rowList[i]
+            self.usec[rows, i]    = self.runs[i][1]
+            self.present[rows, i] = True
+
+        return (self.labels, self.usec)
+
+    def runIndex(self, run):
+        if isinstance(run, int):
+            return run
+        return self.runNames.index(run)
+
+    #------------------------------------------------------------
+    # Compare every run against the baseline run.  Returns label x
+    # run matrices of the change in time (delta), the ratio of times
+    # (ratio; nan where the baseline time is zero), and the change as
+    # a percentage of the baseline time (frac; +/-100% for labels the
+    # baseline doesn't have)
+    #------------------------------------------------------------
+
+    def compare(self, baseline=0):
+        numpy = loadNumpy()
+        (labels, usec) = self.matrix()
+        base = usec[:, self.runIndex(baseline)][:, numpy.newaxis]
+
+        delta = usec - base
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            ratio = numpy.where(base != 0, usec / base, numpy.nan)
+            frac  = numpy.where(base != 0, 100 * delta / numpy.abs(base), 100 * numpy.sign(delta))
+
+        return (delta, ratio, frac)
+
+    #------------------------------------------------------------
+    # Return the regressions against the baseline: every (run, label,
+    # delta, frac) whose delta (or frac, if useFrac) exceeds
+    # threshold, largest first
+    #------------------------------------------------------------
+
+    def regressions(self, baseline=0, threshold=0.0, useFrac=False):
+        numpy = loadNumpy()
+        (delta, ratio, frac) = self.compare(baseline)
+
+        if useFrac:
+            val = frac
+        else:
+            val = delta
+
+        (rows, cols) = numpy.nonzero(val > threshold)
+        order = numpy.argsort(-val[rows, cols], kind='mergesort')
+        rows  = rows[order]
+        cols  = cols[order]
+
+        return [(self.runNames[c], self.labels[r], delta[r, c], frac[r, c]) for (r, c) in itertools.izip(rows.tolist(), cols.tolist())]
+
+    #------------------------------------------------------------
+    # Return a profiler dictionary of the deltas between run and the
+    # baseline, for every label present in either, in the form
+    # DiGraph expects when isDelta is set.  frac is the percent change
+    # against the baseline, so it is unbounded
+    #------------------------------------------------------------
+
+    def deltaDict(self, run, baseline=0):
+        numpy = loadNumpy()
+        (delta, ratio, frac) = self.compare(baseline)
+        iRun  = self.runIndex(run)
+        iBase = self.runIndex(baseline)
+
+        rows = numpy.nonzero(self.present[:, iRun] | self.present[:, iBase])[0]
+
+        labelDict = {}
+        for label, usec, refusec, d, f in itertools.izip(self.labels[rows].tolist(), self.usec[rows, iRun].tolist(), self.usec[rows, iBase].tolist(), delta[rows, iRun].tolist(), frac[rows, iRun].tolist()):
+            labelDict[label] = {'usec': usec, 'refusec': refusec, 'corrusec': d, 'frac': f}
+        return labelDict
+
+    #------------------------------------------------------------
+    # Put digraph into delta mode, showing run against baseline
+    #------------------------------------------------------------
+
+    def apply(self, digraph, run, baseline=0):
+        digraph.profilerActualDict = self.deltaDict(run, baseline)
+        digraph.isDelta = True
+        digraph.nOp = 1
+
+    #------------------------------------------------------------
+    # Render every run against the baseline into digraph, to files
+    # named prefix_<run>.  The digraph is switched to incremental
+    # mode, so that it can be re-rendered for each run, and only the
+    # nodes whose deltas change are rebuilt.  Returns the file names
+    #------------------------------------------------------------
+
+    def renderComparisons(self, digraph, prefix, baseline=0):
+        digraph.incremental = True
+        iBase = self.runIndex(baseline)
+        names = []
+        for i in range(len(self.runNames)):
+            if i != iBase:
+                name = prefix + '_' + str(self.runNames[i])
+                self.apply(digraph, i, iBase)
+                digraph.render(name)
+                names.append(name)
+        return names
+
+#=======================================================================
+# Class for following a profiler output file as it is appended to.
+# Only the bytes added since the last poll are read, and a record is
+# complete once a line for each of the profiler keywords has been seen
+#=======================================================================
+
+class ProfilerFollower(object):
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.offset   = 0
+        self.partial  = ''
+        self.lines    = {}
+
+    #------------------------------------------------------------
+    # Read whatever has been appended since the last poll.  Returns
+    # the columns (see readProfilerFile()) of the latest record
+    # completed, or None if no record was completed
+    #------------------------------------------------------------
+
+    def poll(self):
+
+        if not os.path.exists(self.fileName):
+            return None
+
+        # Start over if the file was truncated or replaced
+
+        if os.path.getsize(self.fileName) < self.offset:
+            self.offset  = 0
+            self.partial = ''
+            self.lines   = {}
+
+        with open(self.fileName) as f:
+            f.seek(self.offset)
+            data = f.read()
+            self.offset = f.tell()
+
+        if len(data) == 0:
+            return None
+
+        # Hold back the last line until its newline arrives
+
+        data = (self.partial + data).split('\n')
+        self.partial = data.pop()
+
+        record = None
+        for line in data:
+            keyword = line.split(' ', 1)[0]
+            if keyword not in profilerKeywords:
+                continue
+            if keyword in self.lines:
+                self.lines = {}
+            self.lines[keyword] = (line + '\n').split(' ')
+            if len(self.lines) == len(profilerKeywords):
+                record = self.lines
+                self.lines = {}
+
+        if record == None:
+            return None
+        return profilerRecordColumns(record)
+
+#=======================================================================
+# Class for a dot subprocess rendering a DOT file, started by
+# DiGraph.renderAsync().  The result dict has the same fields as
+# those of renderMany()
+#=======================================================================
+
+class RenderJob(object):
+
+    def __init__(self, name, engine, outputFormat, buildTime=0.0, timeout=None):
+        self.timeout = timeout
+        self.result  = {'name': name, 'file': None, 'buildTime': buildTime, 'time': 0.0, 'error': None}
+        self.done    = False
+        self.start   = time.time()
+
+        # Run dot as graphviz.render() would, from the directory of
+        # the DOT file
+
+        (dirName, fileName) = os.path.split(name)
+        (cmd, rendered) = gv.backend.command(engine, outputFormat, fileName)
+        self.rendered = os.path.join(dirName, rendered)
+
+        self.stderr = tempfile.TemporaryFile()
+        try:
+            self.process = subprocess.Popen(cmd, cwd=dirName or None, stdout=self.stderr, stderr=self.stderr)
+        except OSError as err:
+            self.process = None
+            self.finish(str(err))
+
+    def finish(self, error):
+        self.result['time']  = time.time() - self.start
+        self.result['error'] = error
+        if error == None:
+            self.result['file'] = self.rendered
+            if self.rendered.endswith('.svg'):
+                inlinePieGlyphs(self.rendered)
+        self.stderr.close()
+        self.done = True
+
+    #------------------------------------------------------------
+    # Check on the subprocess, killing it if it has overrun its
+    # timeout.  Returns True once the job is done
+    #------------------------------------------------------------
+
+    def poll(self):
+        if self.done:
+            return True
+
+        status = self.process.poll()
+        if status == None:
+            if self.timeout != None and time.time() - self.start > self.timeout:
+                self.process.kill()
+                self.process.wait()
+                self.finish('timed out after ' + str(self.timeout) + ' s')
+                return True
+            return False
+
+        if status == 0:
+            self.finish(None)
+        else:
+            self.stderr.seek(0)
+            self.finish('dot exited with status ' + str(status) + ': ' + self.stderr.read().strip())
+        return True
+
+    def wait(self, pollInterval=0.01):
+        while not self.poll():
+            time.sleep(pollInterval)
+        return self.result
 
 #=======================================================================
 # Global module functions
 #=======================================================================
 
+#-----------------------------------------------------------------------
+# Render DOT source to file name in the given format.  Returns a dict
+# of the output file, the time spent in graphviz, and the error
+# message (or None).  This is the unit of work for renderMany()
+#-----------------------------------------------------------------------
+
+def renderSource(job):
+    (name, source, outputFormat) = job
+    result = {'name': name, 'file': None, 'time': 0.0, 'error': None}
+    start = time.time()
+    try:
+        result['file'] = gv.Source(source, format=outputFormat).render(filename=name)
+        if outputFormat == 'svg':
+            inlinePieGlyphs(result['file'])
+    except Exception as err:
+        result['error'] = str(err)
+    result['time'] = time.time() - start
+    return result
+
+#-----------------------------------------------------------------------
+# Render a batch of graphs across a pool of nWorker processes
+# (default: one per cpu).  graphs is a list of (name, graph) pairs,
+# where graph is either a DiGraph or a string of DOT source (rendered
+# in outputFormat).  DiGraphs are built in this process; only the
+# graphviz step runs in the pool.  Returns one result dict per graph,
+# in order, with the build and render times and any error
+#-----------------------------------------------------------------------
+
+def renderMany(graphs, nWorker=None, outputFormat='png'):
+
+    jobs    = []
+    results = []
+    for (name, graph) in graphs:
+        start = time.time()
+        error = None
+        if isinstance(graph, DiGraph):
+            try:
+                if graph.fastDot or graph.incremental:
+                    buf = StringIO.StringIO()
+                    graph.writeDot(buf)
+                    job = (name, buf.getvalue(), graph.dg.format)
+                else:
+                    graph.build()
+                    job = (name, graph.dg.source, graph.dg.format)
+            except Exception as err:
+                job = None
+                error = str(err)
+        else:
+            job = (name, graph, outputFormat)
+        jobs.append(job)
+        results.append({'name': name, 'file': None, 'buildTime': time.time() - start, 'time': 0.0, 'error': error})
+
+    todo = [job for job in jobs if job != None]
+
+    if nWorker == 1:
+        rendered = map(renderSource, todo)
+    else:
+        pool = multiprocessing.Pool(nWorker)
+        try:
+            rendered = pool.map(renderSource, todo)
+        finally:
+            pool.close()
+            pool.join()
+
+    rendered = iter(rendered)
+    for i in range(len(jobs)):
+        if jobs[i] != None:
+            results[i].update(rendered.next())
+
+    return results
+
+#-----------------------------------------------------------------------
+# Read a call-trace file for DiGraph.buildCallGraph().  Each line is
+# either 'parent child', or a single label with no parent; blank lines
+# and lines starting with '#' are skipped
+#-----------------------------------------------------------------------
+
+def readCallFile(fileName):
+    calls = []
+    with open(fileName) as f:
+        for line in f:
+            words = line.split()
+            if len(words) == 0 or words[0].startswith('#'):
+                continue
+            if len(words) == 1:
+                calls.append((None, words[0]))
+            else:
+                calls.append((words[0], words[1]))
+    return calls
+
+#-----------------------------------------------------------------------
+# Render a batch of (name, digraph) pairs, overlapping the Python side
+# of each render (labels, pie-charts and DOT source) with the dot
+# subprocesses of the ones before it.  At most maxRunning dot
+# processes (default: one per cpu) run at once, and any that runs for
+# longer than timeout seconds is killed.  Returns one result dict per
+# graph, in order, as renderMany() does
+#-----------------------------------------------------------------------
+
+def renderPipeline(graphs, maxRunning=None, timeout=None, pollInterval=0.01):
+
+    if maxRunning == None:
+        maxRunning = multiprocessing.cpu_count()
+
+    jobs    = []
+    running = []
+    for (name, graph) in graphs:
+
+        while len(running) >= maxRunning:
+            running = [job for job in running if not job.poll()]
+            if len(running) >= maxRunning:
+                time.sleep(pollInterval)
+
+        try:
+            job = graph.renderAsync(name, timeout)
+        except Exception as err:
+            job = None
+            jobs.append({'name': name, 'file': None, 'buildTime': 0.0, 'time': 0.0, 'error': str(err)})
+        if job != None:
+            jobs.append(job)
+            running.append(job)
+
+    while len(running) > 0:
+        running = [job for job in running if not job.poll()]
+        if len(running) > 0:
+            time.sleep(pollInterval)
+
+    results = []
+    for job in jobs:
+        if isinstance(job, RenderJob):
+            results.append(job.result)
+        else:
+            results.append(job)
+    return results
+
+#-----------------------------------------------------------------------
+# Read node positions from a graphviz plain-format layout, as pinned
+# 'x,y!' positions in points (plain coordinates are in inches)
+#-----------------------------------------------------------------------
+
+def readPlainPositions(fileName):
+    positions = {}
+    with open(fileName) as f:
+        for line in f:
+            if not line.startswith('node '):
+                continue
+            rest = line[5:]
+            if rest.startswith('"'):
+                end  = rest.index('"', 1)
+                tag  = rest[1:end]
+                rest = rest[end+1:]
+            else:
+                (tag, rest) = rest.split(' ', 1)
+            (x, y) = rest.split()[:2]
+            positions[tag] = str(float(x) * 72) + ',' + str(float(y) * 72) + '!'
+    return positions
+
 #-----------------------------------------------------------------------
 # Sanitize a label to a valid string for graphviz (edge() for example,  interprets
 # 'pref:sub' as a particular construct, which we don't want)
@@ -727,60 +2515,217 @@ def getLine(label, content):
     return []
 
 #-----------------------------------------------------------------------
-# Parse a profiler output file
+# Parse a profiler output file into a dictionary of label entries,
+# merged into labelDict.  If profilerCacheDir is set, the parsed
+# columns are cached there (see cachedProfilerFile())
 #-----------------------------------------------------------------------
 
+profilerCacheDir = None
+
 def parseProfilerOutput(fileName, labelDict):
 
+    with instrumentation.phase('parse'):
+        if profilerCacheDir != None:
+            (labels, usec, counts, totalcount, firstusec) = cachedProfilerFile(fileName)
+            (labels, usec, counts) = (labels.tolist(), usec.tolist(), counts.tolist())
+        else:
+            (labels, usec, counts, totalcount, firstusec) = readProfilerFile(fileName)
+
+        for label, u, c in itertools.izip(labels, usec, counts):
+            labelDict[label] = {'usec': float(u), 'count': int(c)}
+
+        labelDict['totalcount'] = totalcount
+        labelDict['firstusec']  = firstusec
+        return labelDict
+
+#-----------------------------------------------------------------------
+# Read the columns of a profiler output file.  The file is streamed
+# once, keeping only the first line for each of the keywords we care
+# about, and reading stops as soon as all of them have been seen.
+# Returns lists of labels, usec and counts, the total count and the
+# first usec value
+#-----------------------------------------------------------------------
+
+profilerKeywords = ['totalcount', 'label', 'count', 'usec']
+
+def readProfilerFile(fileName):
+
+    lines = {}
     with open(fileName) as f:
-        content = f.readlines()
+        for line in f:
+            keyword = line.split(' ', 1)[0]
+            if keyword in profilerKeywords and keyword not in lines:
+                lines[keyword] = line.split(' ')
+                if len(lines) == len(profilerKeywords):
+                    break
 
-    nline = len(content)
+    return profilerRecordColumns(lines)
 
-    totalcount = getLine('totalcount', content)
-    labels     = getLine('label',      content)
-    counts     = getLine('count',      content)
-    usec       = getLine('usec',       content)
+#-----------------------------------------------------------------------
+# Convert a profiler record (a dict of keyword -> split line) into the
+# columns returned by readProfilerFile()
+#-----------------------------------------------------------------------
 
-    print 'len = ' + str(len(labels))
-    
-    if len(labels) != 0:
-        for i in range(1, len(labels)):
-            label = labels[i].replace("'", "")
-            label = label.replace("\n", "")
+def profilerRecordColumns(lines):
+
+    totalcount = lines.get('totalcount', [])
+    labels     = lines.get('label',      [])
+    counts     = lines.get('count',      [])
+    usec       = lines.get('usec',       [])
 
-            print 'label = ' + label + ' size = ' + str(len(label))
-            print 'i = ' + str(i) + ' usec = ' + str(usec[i+1])
+    labelList = []
+    usecList  = []
+    countList = []
+    if len(labels) != 0:
+        for label, u, c in itertools.izip(labels[1:], usec[2:], counts[2:]):
+            label = label.replace("'", "").replace("\n", "")
             if len(label) > 0:
-                labelDict[label] = {}
-                labelDict[label]['usec']  = float(usec[i+1])
-                labelDict[label]['count'] = int(counts[i+1])
-                print 'READ LABEL ' + label + ' usec = ' + str(usec[i+1])
+                labelList.append(label)
+                usecList.append(float(u))
+                countList.append(int(c))
     else:
         for i in range(2, len(usec)):
-            label = str(i)
-            labelDict[label] = {}
-            labelDict[label]['usec']  = float(usec[i])
-            labelDict[label]['count'] = int(counts[i])
+            labelList.append(str(i))
+            usecList.append(float(usec[i]))
+            countList.append(int(counts[i]))
 
     total = totalcount[1]
     total = total.replace("'", "")
     total = total.replace("\n", "")
     
-    labelDict['totalcount'] = int(total)
-    labelDict['firstusec']  = float(usec[2])
-    print 'HERE'
+    return (labelList, usecList, countList, int(total), float(usec[2]))
+
+#-----------------------------------------------------------------------
+# Return the columns of a profiler output file (as readProfilerFile()
+# does, but as numpy arrays), from a binary cache in
+# profilerCacheDir.  Each file is cached under a hash of its path, and
+# the cache is used only if the file's size and modification time
+# still match; otherwise the file is parsed and the cache rewritten
+#-----------------------------------------------------------------------
+
+def cachedProfilerFile(fileName):
+
+    numpy = loadNumpy()
+
+    path = os.path.abspath(fileName)
+    info = os.stat(path)
+    key  = numpy.array([info.st_size, info.st_mtime], dtype=float)
+
+    cacheFile = os.path.join(profilerCacheDir, hashlib.sha1(path).hexdigest() + '.npz')
+
+    # A missing, stale or corrupt cache is reparsed and rewritten.
+    # Truncated files are caught by is_zipfile() before numpy sees them
+
+    try:
+        if zipfile.is_zipfile(cacheFile):
+            with numpy.load(cacheFile) as cached:
+                if numpy.array_equal(cached['key'], key):
+                    return (cached['labels'], cached['usec'], cached['count'], int(cached['totalcount']), float(cached['firstusec']))
+    except (IOError, KeyError, ValueError, EOFError, zipfile.BadZipfile):
+        pass
+
+    (labels, usec, counts, totalcount, firstusec) = readProfilerFile(fileName)
+
+    labels = numpy.array(labels, dtype=str)
+    usec   = numpy.array(usec,   dtype=float)
+    counts = numpy.array(counts, dtype=int)
+
+    # Write to a temporary file and rename it into place, so that
+    # concurrent readers never see a partial cache
+
+    if not os.path.isdir(profilerCacheDir):
+        try:
+            os.makedirs(profilerCacheDir)
+        except OSError:
+            pass
+
+    tmpFile = cacheFile + '.' + str(os.getpid()) + '.tmp'
+    with open(tmpFile, 'wb') as f:
+        numpy.savez(f, key=key, labels=labels, usec=usec, count=counts, totalcount=totalcount, firstusec=firstusec)
+    os.rename(tmpFile, cacheFile)
+
+    return (labels, usec, counts, totalcount, firstusec)
+
+#-----------------------------------------------------------------------
+# Return the label entries of a parsed profiler dictionary as aligned
+# numpy arrays of (labels, usec, count)
+#-----------------------------------------------------------------------
+
+def profilerColumns(labelDict):
+    numpy  = loadNumpy()
+    labels = []
+    usec   = []
+    count  = []
+    for key, val in labelDict.iteritems():
+        if isinstance(val, dict):
+            labels.append(key)
+            usec.append(val['usec'])
+            count.append(val['count'])
+    return (numpy.array(labels, dtype=object), numpy.array(usec, dtype=float), numpy.array(count, dtype=float))
+
+#-----------------------------------------------------------------------
+# Align any number of label columns.  Returns the sorted union of the
+# labels, and for each column the rows of its labels in the union
+#-----------------------------------------------------------------------
+
+def alignLabels(columns):
+    numpy = loadNumpy()
+    if len(columns) > 0:
+        labels = numpy.unique(numpy.concatenate(columns))
+    else:
+        labels = numpy.array([], dtype=object)
+    return (labels, [numpy.searchsorted(labels, column) for column in columns])
+
+#-----------------------------------------------------------------------
+# Parse profiler samples across a pool of nWorker processes (default:
+# one per cpu).  Each sample is a file name, or a tuple of file names
+# (a client and server file, say) merged into one dictionary
+#-----------------------------------------------------------------------
+
+def parseProfilerSample(sample):
+    if isinstance(sample, basestring):
+        sample = (sample,)
+    labelDict  = {}
+    totalcount = 0
+    firstusec  = None
+    for fileName in sample:
+        labelDict = parseProfilerOutput(fileName, labelDict)
+        totalcount += labelDict['totalcount']
+        if firstusec == None:
+            firstusec = labelDict['firstusec']
+    labelDict['totalcount'] = totalcount
+    labelDict['firstusec']  = firstusec
     return labelDict
 
+def parseProfilerSamples(samples, nWorker=None):
+    if nWorker == 1 or len(samples) < 2:
+        return map(parseProfilerSample, samples)
+    pool = multiprocessing.Pool(nWorker)
+    try:
+        return pool.map(parseProfilerSample, samples)
+    finally:
+        pool.close()
+        pool.join()
+
+#-----------------------------------------------------------------------
+# Format a list of (statistic, usec) pairs for a label
+#-----------------------------------------------------------------------
+
+statPrefix = {'mean': 'mean ', 'median': 'med ', 'p95': 'p95 ', 'spread': '&plusmn;'}
+
+def getStatsStr(stats, nQuery):
+    return ' '.join([statPrefix[name] + getTimeStr(usec/nQuery) for (name, usec) in stats])
+
 #-----------------------------------------------------------------------
 # Generate a pie-chart of fractional time
 #-----------------------------------------------------------------------
 
 def getTimeStr(timeInUsec, delta=False):
-    if numpy.abs(timeInUsec) < 1000:
+    absUsec = abs(timeInUsec)
+    if absUsec < 1000:
         ts = str(int(timeInUsec)) + ' &mu;s'
-    elif numpy.abs(timeInUsec) < 1000000:
-        ts = str('%1.1f' % (float(timeInUsec)/1000)) + ' ms'
+    elif absUsec < 1000000:
+        ts = '%1.1f ms' % (float(timeInUsec)/1000)
     else:
         ts = str(int(float(timeInUsec)/1000000)) + ' s'
 
@@ -789,15 +2734,130 @@ def getTimeStr(timeInUsec, delta=False):
     else:
         return ts
 
-def pieGen(frac, color):
-    frac = int(frac)
-    colors = [color, 'w']
-    fracs = [frac,100-frac]
+#-----------------------------------------------------------------------
+# Generate a pie-chart of fractional time.  Charts are named by
+# (fraction, color, size), so each is drawn at most once: later
+# requests are served from pieCache, or from the file left on disk by
+# an earlier render or process.  The file name is relative to the
+# working directory, so pieCache is keyed on it too, and
+# checkPieCache() drops any charts that have since been deleted.
+# With vector set, the chart is a small SVG written directly (no
+# matplotlib), for SVG output, where inlinePieGlyphs() later replaces
+# it with an inline glyph.  Returns the file name
+#-----------------------------------------------------------------------
+
+pieCache = {}
+
+def pieGen(frac, color, size=1, vector=False):
+    with instrumentation.phase('pie'):
+        frac = int(frac)
+        key = (os.getcwd(), frac, color, size, vector)
+
+        if key in pieCache:
+            return pieCache[key]
+
+        if vector:
+            fname = 'figs/pc_' + color + '_' + str(size) + '_' + str(frac) + '.svg'
+        else:
+            fname = 'figs/pc_' + color + '_' + str(size) + '_' + str(frac) + '.png'
+
+        if not os.path.isfile(fname):
+            if not os.path.isdir('figs'):
+                os.mkdir('figs')
+
+            if vector:
+                with open(fname, 'w') as f:
+                    f.write('<svg xmlns="http://www.w3.org/2000/svg" width="' + str(100 * size) + 'px" height="' + str(100 * size) + 'px" viewBox="0 0 100 100">' + pieShapes(frac, color) + '</svg>\n')
+            else:
+                pylab = loadPylab()
+                colors = [color, 'w']
+                fracs = [frac,100-frac]
 
-    fig,ax = pylab.subplots(figsize=(1,1))
-    pie = ax.pie(fracs,colors=colors, shadow=False, startangle=90, counterclock=False)
+                fig,ax = pylab.subplots(figsize=(size,size))
+                pie = ax.pie(fracs,colors=colors, shadow=False, startangle=90, counterclock=False)
 
-    fname = 'figs/pc_' + str(int(frac)) + '.png'
-    pylab.savefig(fname)
-    pylab.close(fig)
+                pylab.savefig(fname)
+                pylab.close(fig)
+
+        pieCache[key] = fname
+        return fname
+
+#-----------------------------------------------------------------------
+# SVG shapes for a pie-chart of frac percent in color, drawn clockwise
+# from 12 o'clock (as pieGen() draws them) in a 100x100 box
+#-----------------------------------------------------------------------
+
+def pieShapes(frac, color):
+    if frac >= 100:
+        return '<circle cx="50" cy="50" r="40" fill="' + color + '"/>'
+
+    shapes = '<circle cx="50" cy="50" r="40" fill="white"/>'
+    if frac > 0:
+        angle = 2 * math.pi * frac / 100
+        x = 50 + 40 * math.sin(angle)
+        y = 50 - 40 * math.cos(angle)
+        shapes += '<path d="M50,50 L50,10 A40,40 0 ' + str(int(frac > 50)) + ',1 ' + ('%.2f,%.2f' % (x, y)) + ' Z" fill="' + color + '"/>'
+    return shapes
+
+#-----------------------------------------------------------------------
+# Replace the references to pieGen() vector charts in an SVG rendered
+# by graphviz with inline glyphs: one shared symbol per chart, and a
+# <use> of it wherever the chart appears, so the file is
+# self-contained
+#-----------------------------------------------------------------------
+
+pieImage = re.compile(r'<image (?:xlink:)?href="([^"]*pc_([^"/_]+)_\d+_(\d+)\.svg)"([^>]*?)/?>(?:</image>)?')
+
+def inlinePieGlyphs(fileName):
+
+    with open(fileName) as f:
+        svg = f.read()
+
+    symbols = {}
+
+    def useGlyph(match):
+        (href, color, frac, attrs) = match.groups()
+        glyph = 'pc_' + color + '_' + frac
+        if glyph not in symbols:
+            symbols[glyph] = '<symbol id="' + glyph + '" viewBox="0 0 100 100">' + pieShapes(int(frac), color) + '</symbol>'
+        return '<use xlink:href="#' + glyph + '"' + re.sub(r'\s*preserveAspectRatio="[^"]*"', '', attrs) + '/>'
+
+    svg = pieImage.sub(useGlyph, svg)
+    if len(symbols) == 0:
+        return
+
+    # The glyphs are defined just inside the root element
+
+    start = svg.index('>', svg.index('<svg')) + 1
+    if 'xmlns:xlink' not in svg[:start]:
+        svg = svg[:start-1] + ' xmlns:xlink="http://www.w3.org/1999/xlink"' + svg[start-1:]
+        start = svg.index('>', svg.index('<svg')) + 1
+    svg = svg[:start] + '\n<defs>' + ''.join([symbols[glyph] for glyph in sorted(symbols)]) + '</defs>' + svg[start:]
+
+    with open(fileName, 'w') as f:
+        f.write(svg)
+
+#-----------------------------------------------------------------------
+# Drop charts in the working directory that no longer exist from
+# pieCache, so that they are drawn again.  Called once per render;
+# returns True if any were dropped
+#-----------------------------------------------------------------------
+
+def checkPieCache():
+    cwd = os.getcwd()
+    missing = [key for (key, fname) in pieCache.iteritems() if key[0] == cwd and not os.path.isfile(fname)]
+    for key in missing:
+        del pieCache[key]
+    return len(missing) > 0
+
+#-----------------------------------------------------------------------
+# Pre-generate pie-charts for every integer percentage in each of
+# the requested colors
+#-----------------------------------------------------------------------
 
+def pieGenAll(colors=['red', 'darkgreen', 'white'], size=1):
+    if not os.path.isdir("figs"):
+        os.mkdir("figs")
+    for color in colors:
+        for frac in range(0, 101):
+            pieGen(frac, color, size)
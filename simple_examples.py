@@ -242,15 +242,15 @@ def graphMultiModuleWithAttr(prefix):
     
     digraph.render(prefix)
 
-graphModules('img/modules')
-graphCallStack('img/call_stack')
-graphFunctionList('img/function_list')
-graphNested('img/nested')
-graphNested2('img/nested2')
-graphBoth('img/both')
-graphFunctionListSameRank('img/function_list_same_rank')
-graphMultiModule('img/multi_module')
-graphMultiModuleWithEdge('img/multi_module_with_edge')
-graphMultiModuleWithAttr('img/multi_module_with_attr')
-
+if __name__ == '__main__':
+    graphModules('img/modules')
+    graphCallStack('img/call_stack')
+    graphFunctionList('img/function_list')
+    graphNested('img/nested')
+    graphNested2('img/nested2')
+    graphBoth('img/both')
+    graphFunctionListSameRank('img/function_list_same_rank')
+    graphMultiModule('img/multi_module')
+    graphMultiModuleWithEdge('img/multi_module_with_edge')
+    graphMultiModuleWithAttr('img/multi_module_with_attr')
 
@@ -0,0 +1,474 @@
+#!/usr/bin/python
+import json
+import os
+import pickle
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+import simple_examples
+import riak_graphviz
+from riak_graphviz import Node, DiGraph, getTag
+
+#-----------------------------------------------------------------------
+# The graphs drawn by simple_examples, plus a profiled graph and a
+# padded one
+#-----------------------------------------------------------------------
+
+examples = ['graphModules', 'graphCallStack', 'graphFunctionList', 'graphBoth',
+            'graphFunctionListSameRank', 'graphNested', 'graphNested2',
+            'graphMultiModule', 'graphMultiModuleWithEdge', 'graphMultiModuleWithAttr']
+
+#-----------------------------------------------------------------------
+# Return the digraph an example would render, instead of rendering it
+#-----------------------------------------------------------------------
+
+def exampleGraph(name):
+    graphs = []
+    render = DiGraph.render
+    DiGraph.render = lambda self, prefix: graphs.append(self)
+    try:
+        getattr(simple_examples, name)('unused')
+    finally:
+        DiGraph.render = render
+    return graphs[0]
+
+def profiledGraph(scale=1.0):
+    digraph = DiGraph({'format':'svg'})
+    node1 = Node({'label':'module1', 'color': 'red'})
+    node1.append(({'label': 'module1:fn1'}, {'label': 'module1:fn2', 'annotation': 'note:here'}))
+    node2 = Node({'label':'module2', 'color': 'blue'})
+    node2.append([{'label': 'module2:fn1'}, {'label': 'module2:fn2'}])
+    digraph.append(node1)
+    digraph.append(node2)
+    digraph.edge('module2:fn2', 'module1:fn2', {'label': 'gen_server:send'})
+    digraph.profilerActualDict = {
+        'module1:fn1': {'usec': 1.0, 'count': 5, 'corrusec': 4000.0 * scale, 'frac': 40.0},
+        'module1:fn2': {'usec': 1.0, 'count': 5, 'corrusec': 200.0, 'frac': 0.5},
+        'module2:fn1': {'usec': 1.0, 'count': 3, 'corrusec': 3000.0, 'frac': 30.0 * scale},
+    }
+    digraph.nOp = 10
+    return digraph
+
+def paddedGraph():
+    digraph = exampleGraph('graphMultiModuleWithEdge')
+    digraph.padToDepth = True
+    return digraph
+
+graphMakers = [(name, lambda name=name: exampleGraph(name)) for name in examples] + \
+              [('profiled', profiledGraph), ('padded', paddedGraph)]
+
+def writeProfile(fileName, labels, counts, usec, totalCount):
+    with open(fileName, 'w') as f:
+        f.write('totalcount ' + str(totalCount) + '\n')
+        f.write('label ' + ' '.join(["'" + label + "'" for label in labels]) + '\n')
+        f.write('count 0 ' + ' '.join([str(count) for count in counts]) + '\n')
+        f.write('usec 0 ' + ' '.join([str(u) for u in usec]) + '\n')
+
+def dotSource(digraph):
+    out = StringIO.StringIO()
+    digraph.writeDot(out)
+    return out.getvalue()
+
+#=======================================================================
+# Tests run in a scratch directory, since pie-charts are written to
+# figs/
+#=======================================================================
+
+class ScratchDirTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpDir = tempfile.mkdtemp()
+        os.chdir(self.tmpDir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpDir)
+
+#=======================================================================
+# The single-pass, direct and incremental DOT paths must all produce
+# the DOT the original multi-pass build did
+#=======================================================================
+
+class TestIdenticalDot(ScratchDirTest):
+
+    # graphviz.Digraph.source has no final newline; the DOT writers
+    # end the file with one
+
+    def multiPassSource(self, makeGraph):
+        digraph = makeGraph()
+        digraph.buildMultiPass()
+        return digraph.dg.source + '\n'
+
+    def testSinglePass(self):
+        for (name, makeGraph) in graphMakers:
+            digraph = makeGraph()
+            digraph.build()
+            self.assertEqual(digraph.dg.source + '\n', self.multiPassSource(makeGraph), name)
+
+    def testDirectWriter(self):
+        for (name, makeGraph) in graphMakers:
+            digraph = makeGraph()
+            digraph.fastDot = True
+            self.assertEqual(dotSource(digraph), self.multiPassSource(makeGraph), name)
+
+    def testIncremental(self):
+        for (name, makeGraph) in graphMakers:
+            digraph = makeGraph()
+            digraph.incremental = True
+            expected = self.multiPassSource(makeGraph)
+            self.assertEqual(dotSource(digraph), expected, name)
+            self.assertEqual(dotSource(digraph), expected, name)
+
+    def testIncrementalNewProfile(self):
+        digraph = profiledGraph()
+        digraph.incremental = True
+        dotSource(digraph)
+        digraph.profilerActualDict = profiledGraph(2.0).profilerActualDict
+        self.assertEqual(dotSource(digraph), self.multiPassSource(lambda: profiledGraph(2.0)))
+
+    def testIncrementalAttrChange(self):
+
+        def grayedGraph():
+            digraph = profiledGraph()
+            digraph.findNode('module1').grayOut()
+            digraph.setAttr('module2:fn2', 'color', 'green')
+            return digraph
+
+        digraph = profiledGraph()
+        digraph.incremental = True
+        dotSource(digraph)
+        digraph.findNode('module1').grayOut()
+        digraph.setAttr('module2:fn2', 'color', 'green')
+        self.assertEqual(dotSource(digraph), self.multiPassSource(grayedGraph))
+
+#=======================================================================
+# Copying and pickling nodes
+#=======================================================================
+
+class TestNode(unittest.TestCase):
+
+    def testCopySharesChildren(self):
+        node = Node({'label': 'm:a'})
+        copy = Node(node)
+        copy.append({'label': 'm:b'})
+        self.assertEqual(len(node.nodes), 1)
+        copy.node_attr['annotationcolor'] = 'red'
+        self.assertEqual(node.node_attr['annotationcolor'], 'red')
+
+    def testPickle(self):
+        node = Node({'label': 'm', 'color': 'red'})
+        node.append(({'label': 'm:a'}, {'label': 'm:b'}))
+        node.node_attr['annotationcolor'] = 'blue'
+        for protocol in [0, pickle.HIGHEST_PROTOCOL]:
+            copy = pickle.loads(pickle.dumps(node, protocol))
+            self.assertEqual(copy.attr, node.attr)
+            self.assertEqual(dict(copy.node_attr.items()), dict(node.node_attr.items()))
+            self.assertEqual([n.attr['label'] for n in copy.walk()], ['m', 'm:a', 'm:b'])
+
+#=======================================================================
+# Pie-charts are cached per working directory
+#=======================================================================
+
+class TestPieCache(ScratchDirTest):
+
+    def testChdir(self):
+        fname = riak_graphviz.pieGen(25, 'red', vector=True)
+        self.assertTrue(os.path.isfile(fname))
+        os.mkdir('other')
+        os.chdir('other')
+        self.assertEqual(riak_graphviz.pieGen(25, 'red', vector=True), fname)
+        self.assertTrue(os.path.isfile(fname))
+
+    def testDeleted(self):
+        digraph = profiledGraph()
+        digraph.incremental = True
+        source = dotSource(digraph)
+        shutil.rmtree('figs')
+        self.assertEqual(dotSource(digraph), source)
+        self.assertTrue(os.path.isfile('figs/pc_red_1_40.svg'))
+
+#=======================================================================
+# Profile ingestion
+#=======================================================================
+
+class TestIngest(ScratchDirTest):
+
+    def testReingestReplaces(self):
+        writeProfile('client1.txt', ['total', 'm:a', 'm:b'], [10, 5, 5], [100000, 40000, 20000], 20)
+        writeProfile('client2.txt', ['total', 'm:a'], [10, 5], [100000, 30000], 20)
+        writeProfile('server.txt', ['n:x'], [1], [10], 1)
+
+        digraph = DiGraph({'format':'png'})
+        digraph.ingestProfilerOutput('client1.txt', 'server.txt', None, None, None, None, 'total')
+        self.assertTrue('m:b' in digraph.profilerActualDict)
+
+        digraph.ingestProfilerOutput('client2.txt', 'server.txt', None, None, None, None, 'total')
+        self.assertFalse('m:b' in digraph.profilerActualDict)
+        self.assertEqual(digraph.profilerActualDict['m:a']['usec'], 30000)
+
+    def testCorruptCache(self):
+        writeProfile('client.txt', ['total', 'm:a'], [10, 5], [100000, 30000], 20)
+        cacheDir = riak_graphviz.profilerCacheDir
+        riak_graphviz.profilerCacheDir = 'cache'
+        try:
+            parsed = riak_graphviz.parseProfilerOutput('client.txt', {})
+            cacheFile = os.path.join('cache', os.listdir('cache')[0])
+            cached = open(cacheFile, 'rb').read()
+            for corrupt in ['garbage', cached[:len(cached) / 2]]:
+                with open(cacheFile, 'wb') as f:
+                    f.write(corrupt)
+                self.assertEqual(riak_graphviz.parseProfilerOutput('client.txt', {}), parsed)
+                self.assertEqual(open(cacheFile, 'rb').read(), cached)
+        finally:
+            riak_graphviz.profilerCacheDir = cacheDir
+
+#=======================================================================
+# Building the tree from call pairs
+#=======================================================================
+
+class TestCallGraph(ScratchDirTest):
+
+    def edgeLines(self, digraph):
+        digraph.fastDot = True
+        return [line.split(' [')[0].strip() for line in dotSource(digraph).splitlines() if ' -> ' in line]
+
+    def testRepeatedPair(self):
+        digraph = DiGraph({'format':'png'}).buildCallGraph([('m:a', 'm:b'), ('m:a', 'm:b')])
+        self.assertEqual([getTag(node.attr) for node in digraph.walk(False)], ['m', 'm_a', 'm_b'])
+        self.assertEqual(digraph.edges, [])
+        self.assertEqual(self.edgeLines(digraph).count('m_a -> m_b'), 1)
+
+    def testRecursive(self):
+        digraph = DiGraph({'format':'png'}).buildCallGraph([('m:a', 'm:a'), ('m:a', 'm:a'), ('m:a', 'm:b')])
+        self.assertEqual([getTag(node.attr) for node in digraph.walk(False)], ['m', 'm_a', 'm_b'])
+        self.assertEqual(self.edgeLines(digraph).count('m_a -> m_a'), 1)
+
+    def testMultipleCallers(self):
+        digraph = DiGraph({'format':'png'}).buildCallGraph([('m:a', 'm:c'), ('n:b', 'm:c'), ('n:b', 'm:c')])
+        self.assertEqual(digraph.findParentOfNode('m:c')[0], digraph.findNode('m:a'))
+        self.assertEqual([(edge[0], edge[1]) for edge in digraph.edges], [('n:b', 'm:c')])
+        edges = self.edgeLines(digraph)
+        self.assertEqual(edges.count('m_a -> m_c'), 1)
+        self.assertEqual(edges.count('n_b -> m_c'), 1)
+
+#=======================================================================
+# Graphviz-free exports
+#=======================================================================
+
+class TestExport(ScratchDirTest):
+
+    def chainGraph(self):
+        digraph = DiGraph({'format':'png'})
+        digraph.append({'label': 'm'}).append(({'label': 'm:a'}, {'label': 'm:x'}, [{'label': 'm:b'}, {'label': 'm:c'}]))
+        digraph.profilerActualDict = {'m:a': {'corrusec': 200.0, 'frac': 50.0, 'count': 4},
+                                      'm:b': {'corrusec': 80.0, 'frac': 20.0, 'count': 2},
+                                      'm:c': {'corrusec': 40.0, 'frac': 10.0, 'count': 1}}
+        digraph.nOp = 2
+        return digraph
+
+    def testFoldedSelfTime(self):
+        out = StringIO.StringIO()
+        self.chainGraph().writeFolded(out)
+        self.assertEqual(out.getvalue().splitlines(), ['m;m:a 40', 'm;m:a;m:x;m:b 40', 'm;m:a;m:x;m:c 20'])
+
+    def testJson(self):
+        out = StringIO.StringIO()
+        self.chainGraph().writeJson(out)
+        tree = json.loads(out.getvalue())
+        self.assertEqual(tree['name'], 'root')
+        [m] = tree['children']
+        [a] = m['children']
+        self.assertEqual((m['name'], a['name'], a['value'], a['frac'], a['count']), ('m', 'm:a', 100.0, 50.0, 4.0))
+        [x] = a['children']
+        self.assertFalse('value' in x)
+        self.assertEqual([(child['name'], child['value']) for child in x['children']], [('m:b', 40.0), ('m:c', 20.0)])
+
+    def testJsonDeep(self):
+        digraph = DiGraph({'format':'png'})
+        digraph.append({'label': 'm'}).append(tuple([{'label': 'm:fn' + str(i)} for i in range(10 * sys.getrecursionlimit())]))
+        out = StringIO.StringIO()
+        digraph.writeJson(out)
+        self.assertEqual(out.getvalue().count('"name"'), 10 * sys.getrecursionlimit() + 2)
+
+#=======================================================================
+# Pruning to the hot paths
+#=======================================================================
+
+class TestPrune(unittest.TestCase):
+
+    def makeGraph(self):
+        digraph = DiGraph({'format':'png'})
+        digraph.append({'label': 'm'}).append([{'label': 'm:a'}, ({'label': 'm:b'}, {'label': 'm:b1'}), {'label': 'm:c'}])
+        digraph.append({'label': 'n'}).append({'label': 'n:x'})
+        digraph.edge('n:x', 'm:c')
+        digraph.edge('n:x', 'm:a')
+        digraph.profilerActualDict = {
+            'm:a':  {'usec': 50.0, 'count': 1, 'corrusec': 50.0, 'frac': 50.0},
+            'm:b':  {'usec': 0.5,  'count': 2, 'corrusec': 0.5,  'frac': 0.5},
+            'm:b1': {'usec': 0.1,  'count': 1, 'corrusec': 0.1,  'frac': 0.1},
+            'm:c':  {'usec': 0.2,  'count': 3, 'corrusec': 0.2,  'frac': 0.2},
+            'n:x':  {'usec': 5.0,  'count': 1, 'corrusec': 5.0,  'frac': 5.0},
+        }
+        return digraph
+
+    def testMinFrac(self):
+        digraph = self.makeGraph()
+        self.assertEqual(digraph.prune(minFrac=1.0), 3)
+        self.assertEqual(digraph.nElided, 3)
+
+        m = digraph.findNode('m')
+        self.assertEqual([getTag(node.attr, False) for node in m.nodes], ['m:a', 'm:elided'])
+        self.assertEqual(m.nodes[1].attr['label'], '3 more')
+        self.assertEqual(m.nodes[1].node_attr['elided'], 3)
+        self.assertEqual(digraph.findNode('m:b1'), None)
+
+        summary = digraph.profilerActualDict['m:elided']
+        self.assertAlmostEqual(summary['corrusec'], 0.7)
+        self.assertAlmostEqual(summary['frac'], 0.7)
+        self.assertEqual(summary['count'], 5)
+
+        self.assertEqual([(edge[0], edge[1]) for edge in digraph.edges], [('n:x', 'm:elided'), ('n:x', 'm:a')])
+
+    def testTopK(self):
+        digraph = self.makeGraph()
+        self.assertEqual(digraph.prune(minFrac=0.0, topK=1), 4)
+        self.assertEqual([getTag(node.attr, False) for node in digraph.walk(False)], ['m', 'm:a', 'm:elided', 'n', 'n:elided'])
+
+    def testPruneTwice(self):
+        digraph = self.makeGraph()
+        digraph.prune(minFrac=1.0)
+        digraph.prune(minFrac=10.0)
+        m = digraph.findNode('m')
+        self.assertEqual([getTag(node.attr, False) for node in m.nodes], ['m:a', 'm:elided'])
+        self.assertEqual(m.nodes[1].attr['label'], '3 more')
+        self.assertEqual(digraph.nElided, 4)
+
+#=======================================================================
+# Comparing runs
+#=======================================================================
+
+class TestProfileComparison(ScratchDirTest):
+
+    def testDeltas(self):
+        writeProfile('base.txt', ['total', 'm:a', 'm:b'], [1, 1, 1], [1000, 100, 50], 3)
+        writeProfile('run.txt', ['total', 'm:a', 'm:c'], [1, 1, 1], [1000, 150, 20], 3)
+        writeProfile('server.txt', ['n:x'], [1], [10], 1)
+
+        comparison = riak_graphviz.ProfileComparison()
+        comparison.addProfile('base', 'base.txt', 'server.txt', None, None, None, 'total')
+        comparison.addProfile('run', 'run.txt', 'server.txt', None, None, None, 'total')
+
+        (labels, usec) = comparison.matrix()
+        self.assertEqual(labels.tolist(), ['m:a', 'm:b', 'm:c', 'n:x', 'total'])
+        self.assertEqual(usec.tolist(), [[100, 150], [50, 0], [0, 20], [10, 10], [1000, 1000]])
+        self.assertEqual(comparison.present[:, 1].tolist(), [True, False, True, True, True])
+
+        deltas = comparison.deltaDict('run', 'base')
+        self.assertEqual((deltas['m:a']['corrusec'], deltas['m:a']['frac']), (50.0, 50.0))
+        self.assertEqual((deltas['m:b']['corrusec'], deltas['m:b']['frac']), (-50.0, -100.0))
+        self.assertEqual((deltas['m:c']['corrusec'], deltas['m:c']['frac']), (20.0, 100.0))
+
+        self.assertEqual([(run, label) for (run, label, delta, frac) in comparison.regressions('base')], [('run', 'm:a'), ('run', 'm:c')])
+
+#=======================================================================
+# Aggregating samples
+#=======================================================================
+
+class TestProfilerSamples(ScratchDirTest):
+
+    def testStats(self):
+        writeProfile('s1.txt', ['total', 'm:a', 'm:b'], [1, 1, 1], [1000, 100, 10], 3)
+        writeProfile('s2.txt', ['total', 'm:a'], [1, 1], [1000, 300], 2)
+        writeProfile('s3.txt', ['total', 'm:b'], [1, 1], [1000, 30], 2)
+
+        digraph = DiGraph({'format':'png'})
+        digraph.ingestProfilerSamples(['s1.txt', 's2.txt', 's3.txt'], None, None, None, 'total', nWorker=1)
+
+        entry = digraph.profilerActualDict['m:a']
+        self.assertEqual(entry['nsample'], 2)
+        self.assertAlmostEqual(entry['corrusec'], 200.0)
+        self.assertAlmostEqual(entry['frac'], 20.0)
+        stats = dict(entry['stats'])
+        self.assertAlmostEqual(stats['median'], 200.0)
+        self.assertAlmostEqual(stats['p95'], 290.0)
+        self.assertAlmostEqual(stats['spread'], 100.0)
+        self.assertAlmostEqual(digraph.profilerActualDict['m:b']['corrusec'], 20.0)
+
+#=======================================================================
+# Following a profiler file as it is written
+#=======================================================================
+
+class TestProfilerFollower(ScratchDirTest):
+
+    def append(self, text):
+        with open('live.txt', 'a') as f:
+            f.write(text)
+
+    def testPartialLines(self):
+        follower = riak_graphviz.ProfilerFollower('live.txt')
+        self.assertEqual(follower.poll(), None)
+
+        self.append("totalcount 20\nlabel 'total' 'm:a'\ncount 0 10 5\nusec 0 10")
+        self.assertEqual(follower.poll(), None)
+        self.append("00 400")
+        self.assertEqual(follower.poll(), None)
+        self.append("\ntotalcount 40\n")
+        self.assertEqual(follower.poll(), (['total', 'm:a'], [1000.0, 400.0], [10, 5], 20, 1000.0))
+
+        self.append("label 'total' 'm:a'\ncount 0 20 10\nusec 0 2000 900\n")
+        self.assertEqual(follower.poll(), (['total', 'm:a'], [2000.0, 900.0], [20, 10], 40, 2000.0))
+        self.assertEqual(follower.poll(), None)
+
+#=======================================================================
+# Tree algorithms on a chain far deeper than the recursion limit
+#=======================================================================
+
+class TestDeepChain(ScratchDirTest):
+
+    def setUp(self):
+        ScratchDirTest.setUp(self)
+        self.nFn = 10 * sys.getrecursionlimit()
+        self.digraph = DiGraph({'format':'png'})
+        node = Node({'label': 'module1'})
+        node.append(tuple([{'label': 'module1:fn' + str(i)} for i in range(self.nFn)]))
+        self.digraph.append(node)
+
+    def testFindNode(self):
+        last = 'module1:fn' + str(self.nFn - 1)
+        self.assertEqual(getTag(self.digraph.findNode(last).attr), getTag({'label': last}))
+        [parent, index] = self.digraph.findParentOfNode(last)
+        self.assertEqual(getTag(parent.attr), 'module1_fn' + str(self.nFn - 2))
+        self.assertEqual(self.digraph.findNode('module1:missing'), None)
+
+    def testDepth(self):
+        self.digraph.setDepth()
+        self.assertEqual(self.digraph.getMaxDepth(), self.nFn)
+        self.assertEqual(getTag(self.digraph.getDeepestNode().attr), 'module1_fn' + str(self.nFn - 1))
+
+    def testInsertBetween(self):
+        tag1 = 'module1:fn' + str(self.nFn - 2)
+        tag2 = 'module1:fn' + str(self.nFn - 1)
+        self.digraph.insertBetween(tag1, tag2, {'label': 'module1:inserted'})
+        [parent, index] = self.digraph.findParentOfNode(tag2)
+        self.assertEqual(getTag(parent.attr), 'module1_inserted')
+        self.digraph.setDepth()
+        self.assertEqual(self.digraph.getMaxDepth(), self.nFn + 1)
+
+    def testBuild(self):
+        self.digraph.build()
+        source = self.digraph.dg.source
+        self.assertEqual(source.count('subgraph subgraph_'), self.nFn + 1)
+        self.assertTrue('\tmodule1_fn' + str(self.nFn - 2) + ' -> module1_fn' + str(self.nFn - 1) in source)
+
+    def testWriteDot(self):
+        self.digraph.fastDot = True
+        source = dotSource(self.digraph)
+        self.assertEqual(source.count('subgraph subgraph_'), self.nFn + 1)
+        self.assertTrue('\tmodule1_fn' + str(self.nFn - 2) + ' -> module1_fn' + str(self.nFn - 1) in source)
+
+if __name__ == '__main__':
+    unittest.main()